@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+"""Time yap commands against generated repositories.
+
+A repository of the requested shape is built once with git fast-import
+and copied afresh for every run, so each command starts from the same
+state.  Every command is run through yap.py exactly as a user would run
+it; its wall time, the number of processes it started (read back from
+YAP_TRACE) and its peak RSS are recorded.  Results are written as JSON
+and can be compared against an earlier results file."""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import optparse
+
+try:
+    import json
+except ImportError:
+    print >> sys.stderr, "Python 2.6 or better required"
+    sys.exit(1)
+
+RESERVED = 4
+
+IDENTITY = {
+    'GIT_AUTHOR_NAME': 'Bench',
+    'GIT_AUTHOR_EMAIL': 'bench@example.com',
+    'GIT_AUTHOR_DATE': '2020-01-01 00:00:00 +0000',
+    'GIT_COMMITTER_NAME': 'Bench',
+    'GIT_COMMITTER_EMAIL': 'bench@example.com',
+    'GIT_COMMITTER_DATE': '2020-01-01 00:00:00 +0000',
+}
+
+def git(args, cwd, input=None):
+    if input is None:
+        stdin = None
+    else:
+        stdin = subprocess.PIPE
+    env = dict(os.environ)
+    env.update(IDENTITY)
+    p = subprocess.Popen(['git'] + args, cwd=cwd, stdin=stdin, env=env)
+    p.communicate(input)
+    if p.returncode:
+        raise RuntimeError("git %s failed in %s" % (' '.join(args), cwd))
+
+def file_path(i, shape):
+    parts = []
+    n = i
+    for level in range(shape['depth']):
+        parts.append('d%d' % (n % shape['fanout']))
+        n = n / shape['fanout']
+    parts.append('f%d.txt' % i)
+    return '/'.join(parts)
+
+def file_contents(i, rev, tag=''):
+    lines = [ "file %d line %d\n" % (i, k) for k in range(10) ]
+    lines.append("revision %d%s\n" % (rev, tag))
+    return ''.join(lines)
+
+class Stream(object):
+    "Writes a fast-import stream with a fixed clock"
+
+    def __init__(self):
+        self.chunks = []
+        self.mark = 0
+        self.when = 1577836800
+
+    def data(self, text):
+        self.chunks.append("data %d\n%s\n" % (len(text), text))
+
+    def commit(self, ref, parent, changes, msg):
+        self.mark += 1
+        self.when += 60
+        self.chunks.append("commit %s\nmark :%d\n" % (ref, self.mark))
+        for who in ('author', 'committer'):
+            self.chunks.append("%s Bench <bench@example.com> %d +0000\n"
+                    % (who, self.when))
+        self.data(msg)
+        if parent:
+            self.chunks.append("from :%d\n" % parent)
+        for path, text in changes:
+            self.chunks.append("M 100644 inline %s\n" % path)
+            self.data(text)
+        return self.mark
+
+    def text(self):
+        return ''.join(self.chunks)
+
+def generate(path, shape):
+    """Create a repository with shape['files'] files spread over
+    directories shape['depth'] deep, shape['commits'] commits of history
+    on master, shape['branches'] side branches, and the branches 'topic'
+    (merges cleanly) and 'conflict' (conflicts with master)."""
+    rng = random.Random(shape['seed'])
+    files = shape['files']
+    if files < RESERVED + 1:
+        raise ValueError("need at least %d files" % (RESERVED + 1))
+    revs = [0] * files
+    s = Stream()
+
+    changes = [ (file_path(i, shape), file_contents(i, 0))
+                for i in range(files) ]
+    tip = s.commit('refs/heads/master', None, changes, "initial import\n")
+    history = [tip]
+
+    # Files below RESERVED are only touched by the commits made at the
+    # end, so that dropping, amending and merging around them is clean
+    for n in range(1, shape['commits'] - 1):
+        changes = []
+        for i in rng.sample(xrange(RESERVED, files),
+                            min(shape['changes'], files - RESERVED)):
+            revs[i] += 1
+            changes.append((file_path(i, shape), file_contents(i, revs[i])))
+        tip = s.commit('refs/heads/master', tip, changes, "change %d\n" % n)
+        history.append(tip)
+    fork = tip
+
+    for b in range(shape['branches']):
+        parent = rng.choice(history)
+        i = rng.randrange(RESERVED, files)
+        s.commit('refs/heads/branch%d' % b, parent,
+                [(file_path(i, shape), file_contents(i, 0, ' branch%d' % b))],
+                "branch %d\n" % b)
+
+    s.commit('refs/heads/topic', fork,
+            [(file_path(2, shape), file_contents(2, 1, ' topic'))],
+            "topic change\n")
+    s.commit('refs/heads/conflict', fork,
+            [(file_path(1, shape), file_contents(1, 1, ' conflict'))],
+            "conflicting change\n")
+    s.commit('refs/heads/master', fork,
+            [(file_path(1, shape), file_contents(1, 1))],
+            "master change\n")
+
+    os.makedirs(path)
+    git(['init', '-q'], path)
+    git(['symbolic-ref', 'HEAD', 'refs/heads/master'], path)
+    git(['config', 'user.name', 'Bench'], path)
+    git(['config', 'user.email', 'bench@example.com'], path)
+    git(['fast-import', '--quiet'], path, s.text())
+    git(['reset', '-q', '--hard', 'master'], path)
+
+def touch(repo, shape, files, tag, stage=False):
+    for i in files:
+        f = open(os.path.join(repo, file_path(i, shape)), 'a')
+        f.write("%s\n" % tag)
+        f.close()
+    if stage:
+        git(['add', '--'] + [ file_path(i, shape) for i in files ], repo)
+
+def setup_status(repo, shape):
+    touch(repo, shape, range(RESERVED, RESERVED + 6), 'unstaged')
+    touch(repo, shape, [0], 'staged', stage=True)
+    return repo
+
+def setup_commit(repo, shape):
+    touch(repo, shape, [0, 3], 'commit', stage=True)
+    return repo
+
+def setup_amend(repo, shape):
+    touch(repo, shape, [3], 'amend', stage=True)
+    return repo
+
+def setup_update(repo, shape):
+    work = repo + '-work'
+    git(['clone', '-q', repo, work], os.path.dirname(repo))
+    git(['config', 'branch.master.remote', 'origin'], work)
+    git(['config', 'branch.master.merge', 'refs/heads/master'], work)
+    touch(repo, shape, [2], 'upstream', stage=True)
+    git(['commit', '-q', '-m', 'upstream change'], repo)
+    touch(work, shape, [3], 'local', stage=True)
+    git(['commit', '-q', '-m', 'local change'], work)
+    return work
+
+def setup_status_all(repo, shape):
+    # Every path shows up, which is what the memory of status scales with
+    touch(repo, shape, range(shape['files']), 'everything')
+    return repo
+
+def setup_add_tree(repo, shape):
+    for i in range(shape['files']):
+        path = os.path.join(repo, 'new', file_path(i, shape))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        f.write("new %d\n" % i)
+        f.close()
+    return repo
+
+def setup_log_follow(repo, shape):
+    # A file that changes all through history, renamed ten times at the end
+    path = file_path(RESERVED, shape)
+    for n in range(10):
+        if n == 9:
+            new = 'followed.txt'
+        else:
+            new = 'renamed%d.txt' % n
+        git(['mv', path, new], repo)
+        git(['commit', '-q', '-m', 'rename %d' % n], repo)
+        path = new
+    return repo
+
+def setup_log_follow_graph(repo, shape):
+    # As yap leaves a repository after commit, fetch or update
+    setup_log_follow(repo, shape)
+    git(['commit-graph', 'write', '--reachable', '--changed-paths',
+            '--split'], repo)
+    return repo
+
+def setup_none(repo, shape):
+    return repo
+
+# name, setup, yap arguments, exit status other than 0 that is expected
+SCENARIOS = [
+    ('status', setup_status, ['status'], None),
+    ('status-all', setup_status_all, ['status'], None),
+    ('add-tree', setup_add_tree, ['add', 'new'], None),
+    ('log', setup_none, ['log'], None),
+    ('log-p', setup_none, ['log', '-p'], None),
+    ('log-n', setup_none, ['log', '-n', '20'], None),
+    ('log-follow', setup_log_follow, ['log', 'followed.txt'], None),
+    ('log-follow-graph', setup_log_follow_graph, ['log', 'followed.txt'],
+        None),
+    ('switch', setup_none, ['switch', 'branch0'], None),
+    ('commit', setup_commit, ['commit', '-m', 'bench'], None),
+    ('history-drop', setup_none, ['history', 'drop', 'HEAD~1'], None),
+    ('history-amend', setup_amend, ['history', 'amend', 'HEAD~1'], None),
+    ('update', setup_update, ['update'], None),
+    ('merge', setup_none, ['merge', 'topic'], None),
+    ('merge-conflict', setup_none, ['merge', 'conflict'], 1),
+]
+
+def child_env(trace, home):
+    env = dict(os.environ)
+    env.update(IDENTITY)
+    env.update({
+        'YAP_TRACE': trace,
+        'YAP_EDITOR': 'true',
+        'YAP_PAGER': 'cat',
+    })
+    env.pop('YAP_DEBUG', None)
+    if home is not None:
+        env['HOME'] = home
+    return env
+
+def run_yap(yap, args, cwd, scratch, home):
+    """Run yap once and return (exit status, wall time, processes started,
+    peak RSS in kilobytes, log file, seconds to the first commit of a log)"""
+    trace = os.path.join(scratch, 'trace')
+    log = os.path.join(scratch, 'output')
+    if os.path.exists(trace):
+        os.unlink(trace)
+    out = open(log, 'w')
+    start = time.time()
+    p = subprocess.Popen([sys.executable, yap] + args, cwd=cwd,
+            stdin=open(os.devnull), stdout=out, stderr=subprocess.STDOUT,
+            env=child_env(trace, home))
+    pid, status, usage = os.wait4(p.pid, 0)
+    wall = time.time() - start
+    p.returncode = os.WEXITSTATUS(status)
+    out.close()
+
+    procs = None
+    first = None
+    if os.path.exists(trace):
+        procs = 0
+        for line in open(trace):
+            event = json.loads(line)
+            # Events for work yap did in-process are not processes
+            if event['argv'][:1] != ['yap']:
+                procs += 1
+            elif event.get('first') is not None:
+                first = event['first']
+    return p.returncode, wall, procs, usage.ru_maxrss, log, first
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def bench(options, shape, names):
+    yap = os.path.abspath(options.yap)
+    scratch = tempfile.mkdtemp(prefix='yap-bench-')
+    try:
+        template = os.path.join(scratch, 'template')
+        print >> sys.stderr, "Generating %(files)d files, %(commits)d commits, " \
+                "%(branches)d branches" % shape
+        generate(template, shape)
+
+        results = dict()
+        for name, setup, args, expected in SCENARIOS:
+            if names and name not in names:
+                continue
+            walls = []
+            rss = []
+            firsts = []
+            procs = None
+            for n in range(options.repeat):
+                repo = os.path.join(scratch, 'repo')
+                for d in repo, repo + '-work':
+                    if os.path.exists(d):
+                        shutil.rmtree(d)
+                shutil.copytree(template, repo, symlinks=True)
+                cwd = setup(repo, shape)
+                rc, wall, procs, maxrss, log, first = run_yap(yap, args, cwd,
+                        scratch, options.home)
+                if rc and rc != expected:
+                    sys.stderr.write(open(log).read())
+                    raise RuntimeError("yap %s exited with %d"
+                            % (' '.join(args), rc))
+                walls.append(wall)
+                rss.append(maxrss)
+                if first is not None:
+                    firsts.append(first)
+            results[name] = dict(wall=median(walls), procs=procs,
+                    rss=median(rss))
+            extra = ''
+            if firsts:
+                results[name]['first'] = median(firsts)
+                extra = "  first commit after %.3fs" % results[name]['first']
+            print >> sys.stderr, "%-16s %8.3fs %6s procs %8d KB%s" % (name,
+                    results[name]['wall'], procs, results[name]['rss'], extra)
+        return results
+    finally:
+        if options.keep:
+            print >> sys.stderr, "Left repositories in %s" % scratch
+        else:
+            shutil.rmtree(scratch)
+
+def compare(results, baseline, options):
+    "Print each metric against the baseline and return the regressions"
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new = results[name]
+        old = baseline[name]
+
+        limit = old['wall'] * (1 + options.threshold) + options.slack
+        if new['wall'] > limit:
+            regressions.append("%s: wall time %.3fs, baseline %.3fs"
+                    % (name, new['wall'], old['wall']))
+        if old.get('procs') is not None and new.get('procs') is not None \
+                and new['procs'] > old['procs']:
+            regressions.append("%s: %d processes, baseline %d"
+                    % (name, new['procs'], old['procs']))
+        if old.get('first') is not None and new.get('first') is not None \
+                and new['first'] > old['first'] * (1 + options.threshold) \
+                    + options.slack:
+            regressions.append("%s: first commit after %.3fs, baseline %.3fs"
+                    % (name, new['first'], old['first']))
+        if new['rss'] > old['rss'] * (1 + options.threshold):
+            regressions.append("%s: peak RSS %d KB, baseline %d KB"
+                    % (name, new['rss'], old['rss']))
+    return regressions
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [scenario...]",
+            description="Scenarios: " + ' '.join([ s[0] for s in SCENARIOS ]))
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_option('--yap', default=os.path.join(here, '..', 'yap.py'),
+            help="yap.py to benchmark (default: this tree's)")
+    parser.add_option('--files', type='int', default=1000)
+    parser.add_option('--depth', type='int', default=3)
+    parser.add_option('--fanout', type='int', default=8,
+            help="directories per level")
+    parser.add_option('--commits', type='int', default=200)
+    parser.add_option('--changes', type='int', default=3,
+            help="files changed per commit")
+    parser.add_option('--branches', type='int', default=10)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--repeat', type='int', default=3,
+            help="runs per scenario; the median is kept")
+    parser.add_option('--home', default=None,
+            help="HOME for yap, to control which plugins load")
+    parser.add_option('-o', '--output', default='bench-results.json',
+            help="where to write the results")
+    parser.add_option('-b', '--baseline', default=None,
+            help="results file to compare against")
+    parser.add_option('--threshold', type='float', default=0.25,
+            help="allowed relative growth in wall time and RSS")
+    parser.add_option('--slack', type='float', default=0.01,
+            help="allowed absolute growth in wall time, in seconds")
+    parser.add_option('--keep', action='store_true',
+            help="keep the generated repositories")
+    options, names = parser.parse_args(argv)
+
+    known = [ s[0] for s in SCENARIOS ]
+    for name in names:
+        if name not in known:
+            parser.error("unknown scenario: %s" % name)
+    if options.commits < 3:
+        parser.error("need at least 3 commits")
+
+    shape = dict(files=options.files, depth=options.depth,
+            fanout=options.fanout, commits=options.commits,
+            changes=options.changes, branches=max(options.branches, 1),
+            seed=options.seed)
+    results = bench(options, shape, names)
+
+    f = open(options.output, 'w')
+    json.dump(dict(shape=shape, results=results), f, indent=1,
+            sort_keys=True)
+    f.write('\n')
+    f.close()
+
+    if options.baseline is None:
+        return 0
+    baseline = json.load(open(options.baseline))
+    if baseline.get('shape') != shape:
+        print >> sys.stderr, "warning: baseline was made with a different shape"
+    regressions = compare(results, baseline['results'], options)
+    for r in regressions:
+        print "REGRESSION %s" % r
+    if regressions:
+        return 1
+    print "No regressions against %s" % options.baseline
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
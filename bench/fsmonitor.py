@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Check the inotify watcher against a full scan.
+
+A repository is generated as in bench.py and a yap daemon is started in
+it with yap.watch enabled, so git asks the daemon which files changed.
+Rounds of random edits are then made to the work tree, and after each
+round the output of git status and yap status is compared between the
+watcher-backed and the full-scan paths.  Any difference is printed and
+makes the exit status non-zero."""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import optparse
+
+import bench
+
+def output(cmd, cwd, env):
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode:
+        raise RuntimeError("%s exited with %d" % (' '.join(cmd), p.returncode))
+    return out
+
+class Tree(object):
+    "Random edits to a work tree"
+
+    def __init__(self, repo, rng):
+        self.repo = repo
+        self.rng = rng
+        self.serial = 0
+
+    def files(self):
+        result = []
+        for dir, dirs, files in os.walk(self.repo):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for f in files:
+                result.append(os.path.relpath(os.path.join(dir, f), self.repo))
+        return result
+
+    def path(self, rel):
+        return os.path.join(self.repo, rel)
+
+    def edit(self):
+        f = self.rng.choice(self.files())
+        fd = open(self.path(f), 'a')
+        fd.write("edit %d\n" % self.serial)
+        fd.close()
+
+    def rewrite_same_size(self):
+        # Same size, so only the mtime gives it away
+        f = self.rng.choice(self.files())
+        data = open(self.path(f)).read()
+        if not data:
+            return
+        fd = open(self.path(f), 'w')
+        fd.write(data[:-1] + chr((ord(data[-1]) + 1) % 128))
+        fd.close()
+
+    def chmod(self):
+        f = self.rng.choice(self.files())
+        mode = os.stat(self.path(f)).st_mode
+        os.chmod(self.path(f), mode ^ 0100)
+
+    def delete(self):
+        os.unlink(self.path(self.rng.choice(self.files())))
+
+    def rename(self):
+        f = self.rng.choice(self.files())
+        os.rename(self.path(f), self.path(f + ".moved"))
+
+    def new_dir(self):
+        base = os.path.dirname(self.rng.choice(self.files()))
+        d = os.path.join(base, "new%d" % self.serial, "deeper")
+        os.makedirs(self.path(d))
+        for i in range(3):
+            fd = open(self.path(os.path.join(d, "f%d" % i)), 'w')
+            fd.write("new\n")
+            fd.close()
+        subprocess.check_call(['git', 'add', d], cwd=self.repo)
+
+    def remove_dir(self):
+        d = os.path.dirname(self.rng.choice(self.files()))
+        if d:
+            shutil.rmtree(self.path(d))
+
+    def restore(self):
+        subprocess.check_call(['git', 'checkout', '-q', '--', '.'],
+                cwd=self.repo)
+
+    def mutate(self, count):
+        actions = [self.edit, self.edit, self.edit, self.rewrite_same_size,
+                self.chmod, self.delete, self.rename, self.new_dir,
+                self.remove_dir, self.restore]
+        for n in range(count):
+            self.serial += 1
+            self.rng.choice(actions)()
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_option('--yap', default=os.path.join(here, '..', 'yap.py'))
+    parser.add_option('--files', type='int', default=500)
+    parser.add_option('--depth', type='int', default=3)
+    parser.add_option('--rounds', type='int', default=50)
+    parser.add_option('--edits', type='int', default=5,
+            help="edits per round")
+    parser.add_option('--seed', type='int', default=1)
+    options, args = parser.parse_args(argv)
+
+    yap = [sys.executable, os.path.abspath(options.yap)]
+    scratch = tempfile.mkdtemp(prefix='yap-fsmonitor-')
+    repo = os.path.join(scratch, 'repo')
+    env = dict(os.environ)
+    env.update(bench.IDENTITY)
+    env.pop('YAP_NO_DAEMON', None)
+    full = dict(env)
+    full['YAP_NO_DAEMON'] = '1'
+
+    failures = 0
+    try:
+        shape = dict(files=options.files, depth=options.depth, fanout=8,
+                commits=5, changes=3, branches=1, seed=options.seed)
+        bench.generate(repo, shape)
+        subprocess.check_call(['git', 'config', 'yap.watch', 'true'],
+                cwd=repo)
+        subprocess.check_call(yap + ['daemon', 'start'], cwd=repo, env=env)
+
+        tree = Tree(repo, random.Random(options.seed))
+        status = ['git', 'status', '--porcelain', '--untracked-files=no']
+        for round in range(options.rounds):
+            tree.mutate(options.edits)
+            # Let the mtime of the next round's edits differ from the index
+            time.sleep(0.01)
+
+            watched = output(status, repo, env)
+            scanned = output(['git', '-c', 'core.fsmonitor='] + status[1:],
+                    repo, env)
+            if watched != scanned:
+                failures += 1
+                print "round %d: git status differs" % round
+                print "  watcher:\n%s  full scan:\n%s" % (watched, scanned)
+
+            watched = output(yap + ['status'], repo, env)
+            scanned = output(yap + ['status'], repo, full)
+            if watched != scanned:
+                failures += 1
+                print "round %d: yap status differs" % round
+                print "  daemon:\n%s  in-process:\n%s" % (watched, scanned)
+    finally:
+        subprocess.call(yap + ['daemon', 'stop'], cwd=repo, env=env)
+        time.sleep(0.2)
+        shutil.rmtree(scratch)
+
+    if failures:
+        print "%d mismatches in %d rounds" % (failures, options.rounds)
+        return 1
+    print "watcher agreed with a full scan in %d rounds" % options.rounds
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Check that commands which need no repository start up quickly.
+
+"yap version" and "yap help" are run repeatedly from an empty directory
+and the median wall time of each is compared against a budget.  The
+exit status is non-zero if any of them is over it."""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import optparse
+
+COMMANDS = [
+    ['version'],
+    ['help'],
+    ['help', 'status'],
+]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def time_command(yap, args, cwd, env, repeat):
+    devnull = open(os.devnull, 'w')
+    walls = []
+    for n in range(repeat):
+        start = time.time()
+        p = subprocess.Popen([sys.executable, yap] + args, cwd=cwd,
+                stdout=devnull, stderr=devnull, env=env)
+        rc = p.wait()
+        walls.append(time.time() - start)
+        if rc:
+            raise RuntimeError("yap %s exited with %d" % (' '.join(args), rc))
+    devnull.close()
+    return median(walls)
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_option('--yap', default=os.path.join(here, '..', 'yap.py'),
+            help="yap.py to time (default: this tree's)")
+    parser.add_option('--budget', type='float', default=50,
+            help="allowed median start-up time in milliseconds")
+    parser.add_option('--repeat', type='int', default=11)
+    parser.add_option('--home', default=None,
+            help="HOME for yap, to control which plugins load")
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("no arguments expected")
+
+    yap = os.path.abspath(options.yap)
+    env = dict(os.environ)
+    env.pop('YAP_TRACE', None)
+    env.pop('YAP_DEBUG', None)
+    # Time yap as installed, with its modules already byte-compiled
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    if options.home is not None:
+        env['HOME'] = options.home
+
+    scratch = tempfile.mkdtemp(prefix='yap-startup-')
+    try:
+        # The first run may write .pyc files and the plugin manifest
+        time_command(yap, ['version'], scratch, env, 1)
+
+        baseline = time_command('-c', ['pass'], scratch, env, options.repeat)
+        over = False
+        print "%-16s %7.1f ms" % ("(python)", baseline * 1000)
+        for args in COMMANDS:
+            wall = time_command(yap, args, scratch, env, options.repeat)
+            name = ' '.join(args)
+            if wall * 1000 > options.budget:
+                over = True
+                print "%-16s %7.1f ms  OVER BUDGET of %.0f ms" % (name,
+                        wall * 1000, options.budget)
+            else:
+                print "%-16s %7.1f ms" % (name, wall * 1000)
+    finally:
+        shutil.rmtree(scratch)
+
+    if over:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -8,7 +8,8 @@ class BackupPlugin(YapCore):
 
     def cmd_revert(self, *args, **flags):
         files = set(args)
-        changed = set(self._get_staged_files() + self._get_unstaged_files())
+        changed = set(self._get_staged_files())
+        changed.update(self._get_unstaged_files())
 
         if '-a' in flags:
             files = changed
@@ -18,5 +19,5 @@ class BackupPlugin(YapCore):
 	files = [ x for x in files if os.access(x, os.R_OK) ]
 
         for f in files:
-	    run_command("cp %s %s~" % (f, f))
+	    run_command(['cp', f, f + '~'])
 	super(BackupPlugin, self).cmd_revert(*args, **flags)
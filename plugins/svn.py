@@ -1,6 +1,7 @@
 
 from yap.yap import YapCore, YapError
-from yap.util import get_output, takes_options, run_command, run_safely, short_help, stdout_is_tty
+from yap.util import get_output, takes_options, run_command, run_safely, run_interactive, short_help, stdout_is_tty, object_reader
+from yap.context import repo_context
 
 import os
 import tempfile
@@ -21,9 +22,9 @@ class RepoBlob(object):
 
     def add_metadata(self, branch):
 	assert branch not in self.metadata
-	gitdir = get_output("git rev-parse --git-dir")
+	gitdir = repo_context().git_dir()
 	assert gitdir
-	revmap = os.path.join(gitdir[0], "svn", "svn", branch, ".rev_map*")
+	revmap = os.path.join(gitdir, "svn", "svn", branch, ".rev_map*")
 	revmap = glob.glob(revmap)
 	if not revmap:
 	    return
@@ -31,7 +32,7 @@ class RepoBlob(object):
 	if self.uuid is None:
 	    self.uuid = uuid
 	assert self.uuid == uuid
-	rev = get_output("git rev-parse refs/remotes/svn/%s" % branch)
+	rev = object_reader().info("refs/remotes/svn/%s" % branch)
 	data = file(revmap[0]).read()
 	self.metadata[branch] = rev[0], data
 
@@ -72,49 +73,56 @@ class SvnPlugin(YapCore):
 	super(SvnPlugin, self).__init__(*args, **flags)
 	self._svn_next_rev = None
 
+    def _parse_info(self, cmd):
+	info = dict()
+	for line in get_output(cmd, quiet=True):
+	    if ': ' in line:
+		k, v = line.split(': ', 1)
+		info[k] = v
+	return info
+
     def _get_root(self, url):
-        root = get_output("svn info %s 2>/dev/null | gawk '/Repository Root:/{print $3}'" % url)
+        root = self._parse_info(['svn', 'info', url]).get('Repository Root')
         if not root:
             raise YapError("Not an SVN repo: %s" % url)
-        return root[0]
+        return root
 
     def _configure_repo(self, url, fetch=None):
         root = self._get_root(url)
-        os.system("git config svn-remote.svn.url %s" % root)
+        self._set_config("svn-remote.svn.url", root)
 	if fetch is None:
 	    trunk = url.replace(root, '').strip('/')
 	else:
 	    trunk = fetch.split(':')[0]
-	os.system("git config svn-remote.svn.fetch %s:refs/remotes/svn/trunk"
-		% trunk)
+	self._set_config("svn-remote.svn.fetch",
+		"%s:refs/remotes/svn/trunk" % trunk)
 
         branches = trunk.replace('trunk', 'branches')
 	if branches != trunk:
-	    os.system("git config svn-remote.svn.branches %s/*:refs/remotes/svn/*" % branches)
+	    self._set_config("svn-remote.svn.branches", "%s/*:refs/remotes/svn/*" % branches)
         tags = trunk.replace('trunk', 'tags')
 	if tags != trunk:
-	    os.system("git config svn-remote.svn.tags %s/*:refs/remotes/svn/tags/*" % tags)
+	    self._set_config("svn-remote.svn.tags", "%s/*:refs/remotes/svn/tags/*" % tags)
         self.cmd_repo("svn", url)
-        os.system("git config yap.svn.enabled 1")
+        self._set_config("yap.svn.enabled", "1")
 
     def _create_tagged_blob(self):
 	keys = dict()
-	for i in get_output("git config --list | grep ^svn-remote."):
-	    k, v = i.split('=')
+	for k, v in self._get_context().config_regexp(r'^svn-remote\.'):
 	    keys[k] = v
 	blob = RepoBlob(keys)
-	for b in get_output("git for-each-ref --format='%(refname)' 'refs/remotes/svn'"):
+	for b in get_output(['git', 'for-each-ref', '--format=%(refname)',
+				'refs/remotes/svn']):
 	    b = b.replace('refs/remotes/svn/', '')
 	    blob.add_metadata(b)
 
-	fd_w, fd_r = os.popen2("git hash-object -w --stdin")
-	pickle.dump(blob, fd_w)
-	fd_w.close()
-	hash = fd_r.readline().strip()
-	run_safely("git tag -f yap-svn %s" % hash)
+	hash = get_output(['git', 'hash-object', '-w', '--stdin'],
+			input=pickle.dumps(blob))[0]
+	run_safely(['git', 'tag', '-f', 'yap-svn', hash])
 
     def _cleanup_branches(self):
-	for b in get_output("git for-each-ref --format='%(refname)' 'refs/remotes/svn/*@*'"):
+	for b in get_output(['git', 'for-each-ref', '--format=%(refname)',
+				'refs/remotes/svn/*@*']):
 	    head = b.replace('refs/remotes/svn/', '')
 	    path = os.path.join(".git", "svn", "svn", head)
             try:
@@ -134,9 +142,9 @@ class SvnPlugin(YapCore):
             except OSError:
                 pass
 
-	    ref = get_output("git rev-parse %s" % b)
+	    ref = self._objects().info(b)
 	    if ref:
-		run_safely("git update-ref -d %s %s" % (b, ref[0]))
+		run_safely(['git', 'update-ref', '-d', b, ref[0]])
 
     def _clone_svn(self, url, directory=None, **flags):
         url = url.rstrip('/')
@@ -152,7 +160,8 @@ class SvnPlugin(YapCore):
 
         self.cmd_init()
         self._configure_repo(url)
-	os.system("git svn fetch --log-window=1000 -r %s:HEAD" % flags.get('-r', '1'))
+	run_interactive(['git', 'svn', 'fetch', '--log-window=1000',
+			'-r', '%s:HEAD' % flags.get('-r', '1')])
 
 	self._cleanup_branches()
 	self._create_tagged_blob()
@@ -161,70 +170,74 @@ class SvnPlugin(YapCore):
         if '-d' in flags:
             raise YapError("Deleting svn branches not supported")
 	print "Verifying branch is up-to-date"
-        run_safely("git svn fetch svn")
+        run_safely(['git', 'svn', 'fetch', 'svn'])
 
         branch = branch.replace('refs/heads/', '')
-	rev = get_output("git rev-parse --verify refs/remotes/svn/%s" % branch)
+	rev = self._objects().info("refs/remotes/svn/%s" % branch)
 
         # Create the branch if requested
         if not rev:
             if '-c' not in flags:
                 raise YapError("No matching branch on the repo.  Use -c to create a new branch there.")
-            src  = get_output("git svn info | gawk '/URL:/{print $2}'")[0]
-            brev = get_output("git svn info | gawk '/Revision:/{print $2}'")[0]
-            root = get_output("git config svn-remote.svn.url")[0]
-            branch_path = get_output("git config svn-remote.svn.branches")[0].split(':')[0]
+            info = self._parse_info(['git', 'svn', 'info'])
+            src  = info['URL']
+            brev = info['Revision']
+            root = self._get_config("svn-remote.svn.url")
+            branch_path = self._get_config("svn-remote.svn.branches").split(':')[0]
             branch_path = branch_path.rstrip('/*')
             dst = '/'.join((root, branch_path, branch))
 
             # Create the branch in svn
-            run_safely("svn cp -r%s %s %s -m 'create branch %s'"
-                    % (brev, src, dst, branch))
-            run_safely("git svn fetch svn")
-            rev = get_output("git rev-parse refs/remotes/svn/%s 2>/dev/null" % branch)
-            base = get_output("git svn find-rev r%s" % brev)
+            run_safely(['svn', 'cp', '-r%s' % brev, src, dst,
+                    '-m', 'create branch %s' % branch])
+            run_safely(['git', 'svn', 'fetch', 'svn'])
+            rev = self._objects().info("refs/remotes/svn/%s" % branch)
+            base = get_output(['git', 'svn', 'find-rev', 'r%s' % brev])
 
             # Apply our commits to the new branch
             try:
                 fd, tmpfile = tempfile.mkstemp("yap")
-                os.close(fd)
-                os.system("git format-patch -k --stdout '%s' > %s"
-                        % (base[0], tmpfile))
-                start = get_output("git rev-parse HEAD")
+                patch = os.fdopen(fd, 'w')
+                try:
+                    run_command(['git', 'format-patch', '-k', '--stdout',
+                            base[0]], stdout=patch)
+                finally:
+                    patch.close()
+                start = self._objects().info("HEAD")
                 self.cmd_point("refs/remotes/svn/%s"
                         % branch, **{'-f': True})
 
                 stat = os.stat(tmpfile)
                 size = stat[6]
                 if size > 0:
-                    rc = run_command("git am -3 %s" % tmpfile)
+                    rc = run_command(['git', 'am', '-3', tmpfile])
                     if (rc):
                         self.cmd_point(start[0], **{'-f': True})
                         raise YapError("Failed to port changes to new svn branch")
             finally:
                 os.unlink(tmpfile)
 
-	base = get_output("git merge-base HEAD %s" % rev[0])
-	if base[0] != rev[0]:
+	if not self._ancestry().is_ancestor(rev[0], self._resolve_rev('HEAD')):
 	    raise YapError("Branch not up-to-date.  Update first.")
-	current = get_output("git symbolic-ref HEAD")
+	current = self._get_head()
 	if not current:
 	    raise YapError("Not on a branch!")
-	current = current[0].replace('refs/heads/', '')
+	current = current.replace('refs/heads/', '')
 	self._confirm_push(current, branch, "svn")
-	if run_command("git update-index --refresh"):
+	if self._refresh_index():
 	    raise YapError("Can't push with uncommitted changes")
 
-	master = get_output("git rev-parse --verify refs/heads/master 2>/dev/null")
-	os.system("git svn dcommit")
-	run_safely("git svn rebase")
+	master = self._objects().info("refs/heads/master")
+	run_interactive(['git', 'svn', 'dcommit'])
+	run_safely(['git', 'svn', 'rebase'])
 	if not master:
-	    master = get_output("git rev-parse --verify refs/heads/master 2>/dev/null")
+	    master = self._objects().info("refs/heads/master")
 	    if master:
-		run_safely("git update-ref -d refs/heads/master %s" % master[0])
+		run_safely(['git', 'update-ref', '-d', 'refs/heads/master',
+				master[0]])
 
     def _lock_svn(self):
-	repo = get_output('git rev-parse --git-dir')[0]
+	repo = self._get_git_dir()
 	dir = os.path.join(repo, 'yap')
 	fd, tmplock = tempfile.mkstemp("yap", dir=dir)
 	try:
@@ -239,7 +252,7 @@ class SvnPlugin(YapCore):
 	    os.unlink(tmplock)
 
     def _unlock_svn(self):
-	repo = get_output('git rev-parse --git-dir')[0]
+	repo = self._get_git_dir()
 	dir = os.path.join(repo, 'yap')
 	lockfile = os.path.join(dir, 'svn-lock')
 
@@ -250,13 +263,14 @@ class SvnPlugin(YapCore):
     
     def _fetch_svn(self):
 	self._lock_svn()
-	os.system("git svn fetch svn")
+	run_interactive(['git', 'svn', 'fetch', 'svn'])
 	self._unlock_svn()
 	self._create_tagged_blob()
 	self._cleanup_branches()
+	self._update_commit_graph()
 
     def _enabled(self):
-	enabled = get_output("git config yap.svn.enabled")
+	enabled = self._get_config("yap.svn.enabled")
 	return bool(enabled)
 
     def _applicable(self, args):
@@ -267,11 +281,11 @@ class SvnPlugin(YapCore):
 	    return True
 
 	if not args:
-	    current = get_output("git symbolic-ref HEAD")
+	    current = self._get_head()
 	    if not current:
 		raise YapError("Not on a branch!")
 
-	    current = current[0].replace('refs/heads/', '')
+	    current = current.replace('refs/heads/', '')
 	    remote, merge = self._get_tracking(current)
 	    if remote == "svn":
 		return True
@@ -294,7 +308,7 @@ class SvnPlugin(YapCore):
 	 	    and not args[0].startswith("svn")
                     and not args[0].startswith("file://")):
 	    handled = False
-	if handled and run_command("svn info %s" % args[0]):
+	if handled and run_command(['svn', 'info', args[0]]):
 	    handled = False
 
 	if handled:
@@ -306,19 +320,19 @@ class SvnPlugin(YapCore):
 	    # nothing to do
 	    return
 
-	run_safely("git fetch origin --tags")
-	hash = get_output("git rev-parse --verify refs/tags/yap-svn 2>/dev/null")
-	if not hash:
+	run_safely(['git', 'fetch', 'origin', '--tags'])
+	blob = self._objects().contents("refs/tags/yap-svn^{blob}")
+	if blob is None:
 	    return
-
-	fd = os.popen("git cat-file blob %s" % hash[0])
-	blob = pickle.load(fd)
+	blob = pickle.loads(blob)
 	for k, v in blob.keys.items():
-	    run_safely("git config %s %s" % (k, v))
+	    if self._set_config(k, v):
+		raise YapError("Failed to set %s" % k)
 
         self.cmd_repo("svn", blob.keys['svn-remote.svn.url'])
-        os.system("git config yap.svn.enabled 1")
-	run_safely("git fetch origin 'refs/remotes/svn/*:refs/remotes/svn/*'")
+        self._set_config("yap.svn.enabled", "1")
+	run_safely(['git', 'fetch', 'origin',
+			'refs/remotes/svn/*:refs/remotes/svn/*'])
 
 	for b in blob.metadata.keys():
 	    branch = os.path.join(".git", "svn", "svn", b)
@@ -333,7 +347,7 @@ class SvnPlugin(YapCore):
 	    rev, metadata = blob.metadata[b]
 	    fd.write(metadata)
 
-	    run_command("git update-ref refs/remotes/svn/%s %s" % (b, rev))
+	    run_command(['git', 'update-ref', 'refs/remotes/svn/%s' % b, rev])
 
     def cmd_fetch(self, *args, **flags):
 	if self._applicable(args):
@@ -347,11 +361,11 @@ class SvnPlugin(YapCore):
 	    if len (args) >= 2:
 		merge = args[1]
 	    else:
-                current = get_output("git symbolic-ref HEAD")
+                current = self._get_head()
                 if not current:
                     raise YapError("Not on a branch!")
 
-                current = current[0].replace('refs/heads/', '')
+                current = current.replace('refs/heads/', '')
                 remote, merge = self._get_tracking(current)
 		if remote != "svn":
 		    raise YapError("Need a branch name")
@@ -370,38 +384,59 @@ class SvnPlugin(YapCore):
 	    raise YapError("A remote named 'svn' already exists")
 
 
-        if not run_command("git config svn-remote.svn.branches"):
+        if self._get_config("svn-remote.svn.branches") is not None:
             raise YapError("Cannot currently enable in a repository with svn branches")
 
-        url = get_output("git config svn-remote.svn.url")
+        url = self._get_config("svn-remote.svn.url")
         if not url:
             raise YapError("Not a git-svn repository?")
-        fetch = get_output("git config svn-remote.svn.fetch")
+        fetch = self._get_config("svn-remote.svn.fetch")
         assert fetch
-        lhs, rhs = fetch[0].split(':')
+        lhs, rhs = fetch.split(':')
 
 
-        rev = get_output("git rev-parse %s" % rhs)
+        rev = self._objects().info(rhs)
         assert rev
-        run_safely("git update-ref refs/remotes/svn/trunk %s" % rev[0])
+        run_safely(['git', 'update-ref', 'refs/remotes/svn/trunk', rev[0]])
 
-        url = '/'.join((url[0], lhs))
+        url = '/'.join((url, lhs))
         self._configure_repo(url)
-        run_safely("git update-ref -d %s %s" % (rhs, rev[0]))
+        run_safely(['git', 'update-ref', '-d', rhs, rev[0]])
 
     # We are intentionally overriding yap utility functions
-    def _filter_log(self, commit):
-        commit = super(SvnPlugin, self)._filter_log(commit)
-
+    def _filter_log(self, lines):
+        lines = super(SvnPlugin, self)._filter_log(lines)
+
+        # Hold each commit's header and message, which are small, until
+        # its git-svn-id line has been seen; the diff streams through
+        commit = None
+        for part, line in lines:
+            if part == 'commit':
+                commit = [(part, line)]
+                continue
+            if commit is not None:
+                if part in ('header', 'message'):
+                    commit.append((part, line))
+                    continue
+                for x in self._annotate_svn(commit):
+                    yield x
+                commit = None
+            yield part, line
+        if commit is not None:
+            for x in self._annotate_svn(commit):
+                yield x
+
+    def _annotate_svn(self, commit):
+        "Replace the git-svn-id line of a commit with a Subversion header"
         new = []
-        for line in commit:
-            if line.strip().startswith("git-svn-id:"):
-                while not new[-1].strip():
+        for part, line in commit:
+            if part == 'message' and line.strip().startswith("git-svn-id:"):
+                while not new[-1][1].strip():
                     new = new[:-1]
 
                 urlrev = line.strip().split(' ')[1]
                 url, rev = urlrev.split('@')
-		m = re.search("commit ([0-9a-f]+)", commit[0])
+		m = re.search("commit ([0-9a-f]+)", commit[0][1])
 		if m is None:
 		    continue
 		hash = m.group(1)
@@ -410,45 +445,45 @@ class SvnPlugin(YapCore):
 		    if h2 != hash:
 			continue
 
-		next_hash = get_output("git rev-parse --verify %s^ 2>/dev/null" % hash)
-		if next_hash:
+		next_hash = self._objects().info("%s^" % hash)
+		if next_hash is not None:
 		    self._svn_next_rev = next_hash[0]
 		else:
 		    self._svn_next_rev = None
-                root = get_output("git config svn-remote.svn.url")
+                root = self._get_config("svn-remote.svn.url")
                 assert root
-                url = url.replace(root[0], '')
+                url = url.replace(root, '')
 
 		if stdout_is_tty():
-		    new.insert(1, "\033[32mSubversion: r%s %s\033[0m\n" % (rev, url))
+		    new.insert(1, ('header',
+			"\033[32mSubversion: r%s %s\033[0m\n" % (rev, url)))
 		else:
-		    new.insert(1, "Subversion: r%s %s\n" % (rev, url))
+		    new.insert(1, ('header', "Subversion: r%s %s\n" % (rev, url)))
 
                 continue
-            new.append(line)
+            new.append((part, line))
         return new
 
     def _resolve_svn_rev(self, revnum):
 	rev = None
-	gitdir = get_output("git rev-parse --git-dir")
+	gitdir = self._get_git_dir()
 	assert gitdir
 
 	# Work with whateven svn remote is configured
-	remotes = get_output("git config --get-regexp 'svn-remote.*.fetch'")
+	remotes = self._get_context().config_regexp(r'svn-remote\..*\.fetch')
 	assert remotes
 
 	revmaps = []
-	for remote in remotes:
-	    remote = remote.split(' ')
-	    remote = remote[1].split(':')
+	for key, remote in remotes:
+	    remote = remote.split(':')
             refspec = remote[1]
 	    remote = remote[1].split('/')
 	    remote = remote[2]
-	    path = os.path.join(gitdir[0], "svn", remote,
+	    path = os.path.join(gitdir, "svn", remote,
 		    "*", ".rev_map*")
 	    revmaps += glob.glob(path)
 
-	    path = os.path.join(gitdir[0], "svn", refspec, ".rev_map*")
+	    path = os.path.join(gitdir, "svn", refspec, ".rev_map*")
 	    revmaps += glob.glob(path)
 
 	for f in revmaps:
@@ -463,9 +498,12 @@ class SvnPlugin(YapCore):
 	    break
 
 	if not rev:
-	    rev = get_output("git svn find-rev r%d 2>/dev/null" % revnum)
-	if not rev:
-	    rev = None
+	    rev = get_output(['git', 'svn', 'find-rev', 'r%d' % revnum],
+			    quiet=True)
+	    if not rev:
+		rev = None
+	    else:
+		rev = rev[0]
 	return rev
 
     def _resolve_rev(self, *args, **flags):
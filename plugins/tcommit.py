@@ -1,6 +1,6 @@
 
 from yap.yap import YapCore
-from yap.util import get_output, takes_options
+from yap.util import takes_options
 import pickle
 import os
 
@@ -8,10 +8,10 @@ class TCommitPlugin(YapCore):
     "Provide a 'temporory commit' mechanism"
 
     def _add_branch(self, branch):
-        repo = get_output("git rev-parse --git-dir")
+        repo = self._get_git_dir()
         if not repo:
             return
-        dir = os.path.join(repo[0], 'yap')
+        dir = os.path.join(repo, 'yap')
 	try:
 	    os.mkdir(dir)
 	except OSError:
@@ -23,8 +23,8 @@ class TCommitPlugin(YapCore):
         pickle.dump(b, file(state_file, 'w'))
 
     def _get_branches(self):
-        repo = get_output("git rev-parse --git-dir")
-        state_file = os.path.join(repo[0], 'yap', 'tcommit')
+        repo = self._get_git_dir()
+        state_file = os.path.join(repo, 'yap', 'tcommit')
 
         try:
             b = pickle.load(file(state_file))
@@ -33,10 +33,10 @@ class TCommitPlugin(YapCore):
         return b
 
     def _remove_branch(self, branch):
-        repo = get_output("git rev-parse --git-dir")
+        repo = self._get_git_dir()
         if not repo:
             return
-        state_file = os.path.join(repo[0], 'yap', 'tcommit')
+        state_file = os.path.join(repo, 'yap', 'tcommit')
 
         b = self._get_branches()
         b.remove(branch)
@@ -54,9 +54,9 @@ class TCommitPlugin(YapCore):
 	super(TCommitPlugin, self).cmd_commit(*args, **flags)
 
 	if override is True:
-            branch = get_output("git symbolic-ref HEAD")
+            branch = self._get_head()
             if branch:
-                self._add_branch(branch[0])
+                self._add_branch(branch)
 
     def cmd_branch(self, *args, **flags):
         if '-d' in flags:
@@ -69,7 +69,7 @@ class TCommitPlugin(YapCore):
     def cmd_switch(self, *args, **flags):
 	super(TCommitPlugin, self).cmd_switch(*args, **flags)
 
-        branch = get_output("git symbolic-ref HEAD")
-        if branch[0] in self._get_branches():
+        branch = self._get_head()
+        if branch in self._get_branches():
             self.cmd_uncommit()
-            self._remove_branch(branch[0])
+            self._remove_branch(branch)
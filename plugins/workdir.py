@@ -12,7 +12,7 @@ class WorkdirPlugin(YapCore):
 	super(WorkdirPlugin, self).__init__(*args, **flags)
 
     def _unlock_branch(self, branch):
-        repo = get_output('git rev-parse --git-dir')[0]
+        repo = self._get_git_dir()
         dir = os.path.join(repo, 'yap', 'lock')
         try:
             os.makedirs(dir)
@@ -27,7 +27,7 @@ class WorkdirPlugin(YapCore):
             pass
 
     def _lock_branch(self, branch, locked_by):
-        repo = get_output('git rev-parse --git-dir')[0]
+        repo = self._get_git_dir()
         dir = os.path.join(repo, 'yap', 'lock')
         try:
             os.makedirs(dir)
@@ -58,7 +58,7 @@ class WorkdirPlugin(YapCore):
 	    os.unlink(tmplock)
 
     def _get_repodir(self):
-        repo = get_output('git rev-parse --git-dir')[0]
+        repo = self._get_git_dir()
 	if not repo.startswith('/'):
 	    repo = os.path.join(os.getcwd(), repo)
         repodir = os.path.dirname(repo)
@@ -70,18 +70,20 @@ command will create a working directory using the contents of that
 branch.  By default, the new working directory will be created in a
 directory adjacent to the current repository, with the branch name
 appended to it; e.g., ../repo-branch.  This path can be overridden by
-specifying a second argument.
+specifying a second argument.  The new working directory shares the
+repository's sparse checkout directories, if any; see 'sparse'.
 """)
     def cmd_workdir(self, branch, workdir=None):
         "<branch> [workdir]"
 
         self._check_git()
 
-        branches = get_output("git for-each-ref --format='%(refname)' 'refs/heads'")
+        branches = get_output(['git', 'for-each-ref', '--format=%(refname)',
+                                'refs/heads'])
         if 'refs/heads/%s' % branch not in branches:
             raise YapError("Not a branch: %s" % branch)
 
-        current = get_output("git symbolic-ref HEAD")[0]
+        current = self._get_head()
 	repodir = self._get_repodir()
 	repo = os.path.join(repodir, '.git')
         if workdir is None:
@@ -112,9 +114,13 @@ specifying a second argument.
 		    os.makedirs(os.path.dirname(x))
 		os.symlink(os.path.join(repo, x), x)
 
-	    run_safely("cp %s HEAD" % os.path.join(repo, 'HEAD'))
+	    run_safely(['cp', os.path.join(repo, 'HEAD'), 'HEAD'])
+	    # git keeps the sparse checkout switch in the per-worktree config
+	    if os.path.exists(os.path.join(repo, 'config.worktree')):
+		run_safely(['cp', os.path.join(repo, 'config.worktree'),
+			    'config.worktree'])
 	    os.chdir("..")
-	    run_safely("git symbolic-ref HEAD refs/heads/%s" % branch)
+	    self._set_head("refs/heads/%s" % branch)
 	    self.cmd_revert(**{'-a': 1})
 	except:
 	    # If we fail, clean up after ourselves
@@ -140,7 +146,7 @@ specifying a second argument.
     def cmd_switch(self, branch, *args, **flags):
         self._check_git()
 
-        current = get_output("git symbolic-ref HEAD")[0]
+        current = self._get_head()
 
 	repodir = self._get_repodir()
         self._lock_branch(branch, repodir)
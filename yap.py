@@ -9,6 +9,82 @@ if sys.version[0] < 2 or sys.version[1] < 3:
     print >> sys.stderr, "Python 2.3 or better required"
     os.exit(1)
 
+# Commands a running "yap daemon" may answer; only without arguments
+daemon_commands = ('status', 'branch', 'repo', 'track', 'version')
+
+def find_daemon():
+    "Return the daemon socket of the repository containing the cwd"
+    # The daemon answers for the repository containing the directory it is
+    # given, so nothing that points git elsewhere can be passed on
+    for var in 'GIT_DIR', 'GIT_WORK_TREE', 'GIT_INDEX_FILE', 'YAP_NO_DAEMON':
+        if var in os.environ:
+            return None
+    d = os.getcwd()
+    while True:
+        git = os.path.join(d, '.git')
+        if os.path.isdir(git):
+            break
+        if os.path.isfile(git):
+            line = open(git).readline()
+            if not line.startswith('gitdir: '):
+                return None
+            git = os.path.join(d, line[8:].strip())
+            break
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+    # A workdir shares .git/yap, and so the socket, with the repository it
+    # was made from, but not its HEAD, index or working tree
+    if os.path.islink(os.path.join(git, 'yap')):
+        return None
+    return os.path.join(git, 'yap', 'daemon.sock')
+
+def ask_daemon(args):
+    """Have the daemon run the command, if one is running and the command
+    is one it answers.  Return the exit status, or None to run it here.
+    See yap/daemon.py for the protocol."""
+    if args[:1] == ['fsmonitor-hook']:
+        # git's core.fsmonitor hook; without a daemon, git must scan
+        request = "yap-fsmonitor 1\n" + '\0'.join(args[1:]) + '\0'
+        fallback = 1
+    elif len(args) == 1 and args[0] in daemon_commands:
+        tty = str(int(os.isatty(1)))
+        request = "yap-daemon 1\n" + '\0'.join([os.getcwd(), tty] + args) + '\0'
+        fallback = None
+    else:
+        return None
+    path = find_daemon()
+    if path is None or not os.path.exists(path):
+        return fallback
+
+    import socket
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(request)
+        s.shutdown(socket.SHUT_WR)
+    except socket.error:
+        return fallback
+
+    f = s.makefile('rb')
+    outputs = { 'o': sys.stdout, 'e': sys.stderr }
+    while True:
+        header = f.readline()
+        if not header:
+            # The daemon went away; we cannot tell what it did
+            return 1
+        channel, size = header.split()
+        data = f.read(int(size))
+        if channel == 'x':
+            return int(data)
+        outputs[channel].write(data)
+        outputs[channel].flush()
+
+rc = ask_daemon(sys.argv[1:])
+if rc is not None:
+    sys.exit(rc)
+
 dir = os.path.dirname(os.path.dirname(sys.argv[0]))
 sys.path.insert(0, os.path.join(dir, 'lib', 'yap'))
 
@@ -0,0 +1,83 @@
+import os
+
+import yap
+from util import get_output, run_command, object_reader
+
+class Ancestry(object):
+    """Answers to questions about how commits are related.  git answers
+    them from the generation numbers in the commit-graph, where there is
+    one, and each answer about two commits is remembered, since it can
+    never change.  The ref tips are read once and kept until forget_refs()
+    is called."""
+
+    def __init__(self):
+        self.ancestors = {}
+        self.bases = {}
+        self.tips = None
+
+    def is_ancestor(self, commit, rev):
+        "Return True if the commit commit is rev or one of its ancestors"
+        if commit == rev:
+            return True
+        key = commit, rev
+        if key not in self.ancestors:
+            self.ancestors[key] = run_command(['git', 'merge-base',
+                    '--is-ancestor', commit, rev]) == 0
+        return self.ancestors[key]
+
+    def merge_base(self, a, b):
+        "Return the best common ancestor of commits a and b, or None"
+        key = min(a, b), max(a, b)
+        if key not in self.bases:
+            base = get_output(['git', 'merge-base', a, b], quiet=True)
+            if base:
+                self.bases[key] = base[0]
+            else:
+                self.bases[key] = None
+        return self.bases[key]
+
+    def _ref_tips(self):
+        if self.tips is None:
+            self.tips = dict()
+            for line in get_output(['git', 'for-each-ref',
+                        '--format=%(refname) %(objectname) %(*objectname)']):
+                fields = line.split()
+                # Tags are peeled to what they point at
+                self.tips[fields[0]] = fields[-1]
+            head = object_reader().info('HEAD')
+            if head is not None:
+                self.tips['HEAD'] = head[0]
+        return self.tips
+
+    def reachable(self, commit, exclude=(), extra=()):
+        """Return True if commit can be reached from a ref other than those
+        in exclude, or from one of the commits in extra; that is, whether
+        it would still be in history without those refs.  If git cannot
+        tell, the answer is False, since callers use True to let commits
+        go."""
+        tips = set([ v for k, v in self._ref_tips().items()
+                     if k not in exclude ])
+        tips.update(extra)
+        if commit in tips:
+            return True
+        # Whatever is left of commit's history once everything reachable
+        # from the tips is taken away; nothing means it is all reachable
+        input = ''.join([ '^%s\n' % x for x in tips ])
+        try:
+            left = get_output(['git', 'rev-list', '-n', '1', '--stdin',
+                               commit], input=input, check=True)
+        except yap.ShellError:
+            return False
+        return not left
+
+    def forget_refs(self):
+        "Read the ref tips again next time; call after refs are changed"
+        self.tips = None
+
+_ancestries = {}
+def ancestry():
+    "Return the Ancestry shared by everything running in this directory"
+    cwd = os.getcwd()
+    if cwd not in _ancestries:
+        _ancestries[cwd] = Ancestry()
+    return _ancestries[cwd]
@@ -0,0 +1,163 @@
+import os
+import re
+import time
+
+from util import _spawn, _get_devnull, _record
+
+def _git(args):
+    import subprocess
+    cmd = ['git'] + args
+    start = time.time()
+    p = _spawn(cmd, stdout=subprocess.PIPE, stderr=_get_devnull())
+    output = p.communicate()[0]
+    _record(cmd, start, p.returncode, len(output))
+    return p.returncode, output
+
+def _canonical_key(key):
+    # Section and variable names are case-insensitive; subsections are not
+    parts = key.split('.')
+    parts[0] = parts[0].lower()
+    parts[-1] = parts[-1].lower()
+    return '.'.join(parts)
+
+class RepoContext(object):
+    """Facts about the repository containing one directory.  Each one is
+    asked of git at most once, and forgotten again when yap changes it."""
+
+    def __init__(self):
+        self._paths = None
+        self._head = None
+        self._config = None
+        self._config_key = None
+
+    def invalidate(self):
+        self._paths = None
+        self._head = None
+        self._config = None
+
+    def _load_paths(self):
+        if self._paths is not None:
+            return self._paths
+        rc, output = _git(['rev-parse', '--git-dir', '--show-prefix',
+                            '--show-cdup'])
+        lines = output.split('\n')
+        if rc or len(lines) < 3:
+            self._paths = (None, None, None)
+        else:
+            self._paths = tuple(lines[:3])
+        return self._paths
+
+    def git_dir(self):
+        "Return the repository directory, or None outside a repository"
+        return self._load_paths()[0]
+
+    def prefix(self):
+        "Return the current directory relative to the top of the tree"
+        return self._load_paths()[1]
+
+    def cdup(self):
+        "Return the path from the current directory to the top of the tree"
+        return self._load_paths()[2]
+
+    def head(self):
+        "Return the ref HEAD points to, or None if it is detached"
+        if self._head is None:
+            rc, output = _git(['symbolic-ref', 'HEAD'])
+            if rc:
+                self._head = ''
+            else:
+                self._head = output.strip()
+        return self._head or None
+
+    def set_head(self, ref):
+        rc, output = _git(['symbolic-ref', 'HEAD', ref])
+        self._head = None
+        return rc
+
+    def _config_file_key(self):
+        gitdir = self.git_dir()
+        if gitdir is None:
+            return None
+        try:
+            st = os.stat(os.path.join(gitdir, 'config'))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _load_config(self):
+        key = self._config_file_key()
+        if self._config is not None and key == self._config_key:
+            return self._config
+
+        config = {}
+        order = []
+        rc, output = _git(['config', '-z', '--list'])
+        for entry in output.split('\0'):
+            if not entry:
+                continue
+            if '\n' in entry:
+                k, v = entry.split('\n', 1)
+            else:
+                k, v = entry, 'true'
+            if k not in config:
+                config[k] = []
+                order.append(k)
+            config[k].append(v)
+        self._config = config
+        self._config_order = order
+        self._config_key = key
+        return config
+
+    def config(self, key, default=None):
+        "Return the last value of a config variable"
+        values = self._load_config().get(_canonical_key(key))
+        if not values:
+            return default
+        return values[-1]
+
+    def config_bool(self, key, default=False):
+        """Return a boolean config variable read as git reads it; raise
+        ValueError if it is not one"""
+        value = self.config(key)
+        if value is None:
+            return default
+        value = value.strip().lower()
+        if value in ('true', 'yes', 'on'):
+            return True
+        if value in ('false', 'no', 'off', ''):
+            return False
+        return int(value) != 0
+
+    def config_all(self, key):
+        "Return every value of a multi-valued config variable"
+        return list(self._load_config().get(_canonical_key(key), []))
+
+    def config_regexp(self, pattern):
+        "Return (key, value) pairs for variables whose name matches pattern"
+        config = self._load_config()
+        pattern = re.compile(pattern)
+        result = []
+        for k in self._config_order:
+            if pattern.search(k) is None:
+                continue
+            for v in config[k]:
+                result.append((k, v))
+        return result
+
+    def set_config(self, key, value):
+        rc, output = _git(['config', key, value])
+        self._config = None
+        return rc
+
+    def unset_config(self, key):
+        rc, output = _git(['config', '--unset', key])
+        self._config = None
+        return rc
+
+_contexts = {}
+def repo_context():
+    "Return the RepoContext shared by everything running in this directory"
+    cwd = os.getcwd()
+    if cwd not in _contexts:
+        _contexts[cwd] = RepoContext()
+    return _contexts[cwd]
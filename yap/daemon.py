@@ -0,0 +1,354 @@
+import os
+import sys
+import errno
+import signal
+import socket
+import threading
+import Queue
+
+import util
+import status
+from context import repo_context
+
+# The client half of this protocol lives in yap.py, which must not import
+# this package to stay fast.  A request is the line "yap-daemon 1", then
+# the current directory, "1" or "0" for whether stdout is a terminal and
+# the arguments, each ended by a NUL.  The reply is a series of frames:
+# a channel letter ('o' stdout, 'e' stderr, 'x' exit status), a space, the
+# length of the data in decimal, a newline, and then the data itself.
+# A git fsmonitor hook query starts with HOOK_MAGIC instead, followed by
+# the hook protocol version and git's last token, and is answered with
+# the same frames carrying the hook's output.
+MAGIC = "yap-daemon 1\n"
+HOOK_MAGIC = "yap-fsmonitor 1\n"
+
+class _Stop(BaseException):
+    "Raised by SIGTERM; not an Exception, so no command can swallow it"
+
+def socket_path(gitdir):
+    return os.path.join(gitdir, 'yap', 'daemon.sock')
+
+def pid_path(gitdir):
+    return os.path.join(gitdir, 'yap', 'daemon.pid')
+
+def running_pid(gitdir):
+    "Return the pid of the daemon serving gitdir, or None"
+    try:
+        pid = int(file(pid_path(gitdir)).read().strip())
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return None
+    return pid
+
+class Channel(object):
+    "A file-like object sending everything written to it as frames"
+
+    def __init__(self, conn, channel):
+        self.conn = conn
+        self.channel = channel
+        self.buffer = []
+        self.size = 0
+        self.softspace = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= 8192:
+            self.flush()
+
+    def writelines(self, lines):
+        for l in lines:
+            self.write(l)
+
+    def flush(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if data:
+            send_frame(self.conn, self.channel, data)
+
+    def isatty(self):
+        return False
+
+def send_frame(conn, channel, data):
+    conn.sendall("%s %d\n%s" % (channel, len(data), data))
+
+def read_request(conn):
+    "Return the magic line and the fields of a request"
+    chunks = []
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        chunks.append(data)
+    data = ''.join(chunks)
+    for magic in MAGIC, HOOK_MAGIC:
+        if data.startswith(magic):
+            break
+    else:
+        return None, None
+    fields = data[len(magic):].split('\0')
+    if len(fields) < 2 or fields.pop() != '':
+        return None, None
+    return magic, fields
+
+def hook_command(yap_script):
+    "Return the core.fsmonitor setting that asks the daemon"
+    import pipes
+    return "%s %s fsmonitor-hook" % (pipes.quote(sys.executable),
+            pipes.quote(os.path.abspath(yap_script)))
+
+class Daemon(object):
+    """Answers commands for one repository from a single long-lived Yap
+    instance, so that imports, plugins, the cat-file co-processes and the
+    repository context stay warm between commands."""
+
+    def __init__(self, yap, gitdir, timeout, watcher=None):
+        self.yap = yap
+        self.gitdir = gitdir
+        self.timeout = timeout
+        self.watcher = watcher
+        self.head_keys = {}
+        self.snapshot_tokens = {}
+        self.requests = Queue.Queue()
+
+    def _head_key(self):
+        """Return what the staged files depend on besides the index: where
+        HEAD points and the commit it resolves to.  The watcher sees none
+        of it, since it does not watch the git dir."""
+        # The HEAD of the repository the request came from, in case it is
+        # not the one the daemon was started in
+        gitdir = repo_context().git_dir() or self.gitdir
+        key = []
+        for name in 'HEAD', 'packed-refs':
+            try:
+                st = os.stat(os.path.join(gitdir, name))
+                key.append((st.st_ino, st.st_mtime, st.st_size))
+            except OSError:
+                key.append(None)
+        key.append(util.object_reader().info('HEAD'))
+        return tuple(key)
+
+    def _refresh(self, cwd):
+        """Forget whatever may have changed since the last command.  The
+        working tree can change without touching the index, so unless the
+        watcher shows that nothing has, the status snapshot is rebuilt."""
+        key = self._head_key()
+        if self.head_keys.get(cwd) != key:
+            repo_context().invalidate()
+            self.head_keys[cwd] = key
+            self.snapshot_tokens.pop(cwd, None)
+
+        if self.watcher is not None:
+            token = self.snapshot_tokens.get(cwd)
+            if token is not None and self.watcher.changed_since(token) == []:
+                return
+            self.snapshot_tokens[cwd] = self.watcher.token()
+        status.forget_snapshot()
+
+    def answer_hook(self, conn, fields):
+        """Answer git's fsmonitor hook: a new token, then every path changed
+        since git's token, or "/" if the watcher cannot tell"""
+        if self.watcher is None or fields[0] != '2' or len(fields) < 2:
+            send_frame(conn, 'x', '1')
+            return
+        token = self.watcher.token()
+        changed = self.watcher.changed_since(fields[1])
+        if changed is None:
+            changed = ['/']
+        send_frame(conn, 'o', '\0'.join([token] + changed) + '\0')
+        send_frame(conn, 'x', '0')
+
+    def handle(self, conn, fields):
+        if len(fields) < 3:
+            return
+        cwd = fields[0]
+        tty = fields[1] == '1'
+        args = fields[2:]
+
+        out = Channel(conn, 'o')
+        err = Channel(conn, 'e')
+        saved = sys.stdout, sys.stderr
+        rc = 0
+        try:
+            sys.stdout, sys.stderr = out, err
+            util.set_stdout_tty(tty)
+            try:
+                os.chdir(cwd)
+                self._refresh(cwd)
+                self.yap.main(args)
+            except SystemExit, e:
+                rc = e.code
+                if rc is None:
+                    rc = 0
+                elif not isinstance(rc, int):
+                    print >>sys.stderr, rc
+                    rc = 1
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                rc = 1
+        finally:
+            sys.stdout, sys.stderr = saved
+            util.set_stdout_tty(None)
+            try:
+                out.flush()
+                err.flush()
+                send_frame(conn, 'x', str(rc))
+            except socket.error:
+                pass
+
+    def accept(self, server):
+        """Read requests as they come.  Hook queries are answered here at
+        once, since the git commands run by a yap command in the main
+        thread call the hook and wait for it.  Whatever goes wrong with
+        one connection is logged and answered with a failure, since git
+        hangs if this thread dies."""
+        while True:
+            try:
+                conn, addr = server.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                magic, fields = read_request(conn)
+                if magic == MAGIC:
+                    self.requests.put((conn, fields))
+                    continue
+                if magic == HOOK_MAGIC:
+                    self.answer_hook(conn, fields)
+            except socket.error:
+                pass
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                try:
+                    send_frame(conn, 'x', '1')
+                except socket.error:
+                    pass
+            conn.close()
+
+    def serve(self, server):
+        acceptor = threading.Thread(target=self.accept, args=(server,))
+        acceptor.setDaemon(True)
+        acceptor.start()
+
+        idle = 0
+        while idle < self.timeout:
+            try:
+                conn, fields = self.requests.get(True, 1)
+            except Queue.Empty:
+                # Keep the kernel's event queue from overflowing
+                if self.watcher is not None:
+                    try:
+                        self.watcher.drain()
+                    except Exception:
+                        import traceback
+                        traceback.print_exc()
+                idle += 1
+                continue
+            idle = 0
+            try:
+                self.handle(conn, fields)
+            finally:
+                conn.close()
+
+def _cleanup(gitdir, hook=None):
+    for path in socket_path(gitdir), pid_path(gitdir):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    if hook is None:
+        return
+    # Stop git asking a hook that would only fail from now on
+    try:
+        value = util.get_output(['git', '--git-dir', gitdir, 'config',
+                                    'core.fsmonitor'], quiet=True)
+        if value == [hook]:
+            util.run_command(['git', '--git-dir', gitdir, 'config',
+                                '--unset', 'core.fsmonitor'])
+    except OSError:
+        pass
+
+def start(yap, gitdir, timeout, watcher=None, hook=None):
+    """Start a daemon for gitdir in the background.  The socket is bound
+    before forking so that any error is reported to the caller.  If a
+    watcher is given, hook is the core.fsmonitor setting that reaches
+    the daemon, and it is removed again when the daemon exits."""
+    path = socket_path(gitdir)
+    try:
+        os.mkdir(os.path.dirname(path))
+    except OSError:
+        pass
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old = os.umask(077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old)
+    server.listen(16)
+
+    pid = os.fork()
+    if pid:
+        server.close()
+        if watcher is not None:
+            watcher.close()
+        os.waitpid(pid, 0)
+        return
+
+    # The grandchild is the daemon; the child records its pid and exits
+    # so that it is reparented
+    gitdir = os.path.abspath(gitdir)
+    os.setsid()
+    pid = os.fork()
+    if pid:
+        f = file(pid_path(gitdir), 'w')
+        f.write("%d\n" % pid)
+        f.close()
+        os._exit(0)
+
+    log = os.open(os.path.join(gitdir, 'yap', 'daemon.log'),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(devnull)
+    os.close(log)
+
+    def terminate(signum, frame):
+        raise _Stop()
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    rc = 0
+    try:
+        try:
+            Daemon(yap, gitdir, timeout, watcher).serve(server)
+        except _Stop:
+            pass
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            rc = 1
+    finally:
+        server.close()
+        _cleanup(gitdir, hook)
+    os._exit(rc)
+
+def stop(gitdir):
+    "Stop the daemon for gitdir; return False if none was running"
+    pid = running_pid(gitdir)
+    if pid is None:
+        _cleanup(gitdir)
+        return False
+    os.kill(pid, signal.SIGTERM)
+    return True
@@ -0,0 +1,194 @@
+import os
+import re
+import stat
+
+class Pattern(object):
+    "One line of a .gitignore file"
+
+    def __init__(self, line, base):
+        self.base = base
+        self.negate = False
+        self.dir_only = False
+        if line.startswith('!'):
+            self.negate = True
+            line = line[1:]
+        if line.endswith('/'):
+            self.dir_only = True
+            line = line.rstrip('/')
+        # A slash anywhere but the end ties the pattern to base; otherwise
+        # it matches a name at any depth below it
+        self.anchored = '/' in line
+        self.regex = _translate(line.lstrip('/'))
+
+    def match(self, path, name, is_dir):
+        "Whether the pattern matches path, which is relative to self.base"
+        if self.dir_only and not is_dir:
+            return False
+        if self.anchored:
+            return self.regex.match(path) is not None
+        return self.regex.match(name) is not None
+
+def _translate(pattern):
+    "Compile a gitignore glob, in which wildcards never match '/'"
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if (pattern[i:i + 1] == '*' and (i == 1 or pattern[i - 2] == '/')
+                    and (i + 1 == n or pattern[i + 1] == '/')):
+                if i + 1 == n:
+                    out.append('.*')
+                    i += 1
+                else:
+                    out.append('(?:.*/)?')
+                    i += 2
+            else:
+                out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i
+            if pattern[j:j + 1] in ('!', '^'):
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append(re.escape(c))
+                continue
+            chars = pattern[i:j].replace('\\', '\\\\')
+            if chars[:1] in ('!', '^'):
+                chars = '^' + chars[1:]
+            out.append('(?!/)[%s]' % chars)
+            i = j + 1
+        elif c == '\\' and i < n:
+            out.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            out.append(re.escape(c))
+    return re.compile(''.join(out) + r'\Z')
+
+def read_patterns(path, base):
+    "Return the patterns in the exclude file at path, or [] if it is missing"
+    try:
+        f = file(path)
+    except IOError:
+        return []
+    patterns = []
+    try:
+        for line in f:
+            line = line.rstrip('\n').rstrip('\r')
+            # Trailing spaces count only when escaped
+            stripped = line.rstrip(' ')
+            if stripped.endswith('\\') and len(stripped) < len(line):
+                stripped += ' '
+            line = stripped
+            if not line or line.startswith('#'):
+                continue
+            patterns.append(Pattern(line, base))
+    finally:
+        f.close()
+    return patterns
+
+class IgnoreRules(object):
+    """Decides which paths git ignores in a work tree, from .gitignore
+    files, info/exclude and core.excludesFile.  Paths are relative to the
+    top of the work tree and use '/'."""
+
+    def __init__(self, top, git_dir, excludes_file=None):
+        self.top = top
+        self.base = []
+        if excludes_file:
+            self.base += read_patterns(os.path.expanduser(excludes_file), '')
+        self.base += read_patterns(os.path.join(git_dir, 'info', 'exclude'),
+                                    '')
+        self.dirs = {}
+        self.ignored_dirs = {}
+
+    def _patterns(self, dir):
+        patterns = self.dirs.get(dir)
+        if patterns is None:
+            path = os.path.join(self.top, dir, '.gitignore')
+            patterns = self.dirs[dir] = read_patterns(path, dir)
+        return patterns
+
+    def match(self, path, is_dir):
+        "Apply the patterns alone, without looking at the parents of path"
+        dir, name = os.path.split(path)
+        parents = ['']
+        if dir:
+            parts = dir.split('/')
+            parents += [ '/'.join(parts[:k]) for k in range(1, len(parts) + 1) ]
+
+        # Deeper .gitignore files take precedence, and so do later lines
+        for parent in reversed(parents):
+            if parent:
+                rel = path[len(parent) + 1:]
+            else:
+                rel = path
+            for pattern in reversed(self._patterns(parent)):
+                if pattern.match(rel, name, is_dir):
+                    return not pattern.negate
+        for pattern in reversed(self.base):
+            if pattern.match(path, name, is_dir):
+                return not pattern.negate
+        return False
+
+    def dir_ignored(self, dir):
+        "Whether dir or any directory above it is ignored"
+        if not dir:
+            return False
+        ignored = self.ignored_dirs.get(dir)
+        if ignored is None:
+            parent = os.path.dirname(dir)
+            ignored = self.dir_ignored(parent) or self.match(dir, True)
+            self.ignored_dirs[dir] = ignored
+        return ignored
+
+    def ignored(self, path, is_dir=False):
+        "Whether git ignores path"
+        if is_dir:
+            return self.dir_ignored(path)
+        return self.dir_ignored(os.path.dirname(path)) \
+                or self.match(path, False)
+
+def walk(dir, repo_dir, rules):
+    """Yield the files and symlinks below dir that rules do not ignore.
+    repo_dir is dir relative to the top of the work tree.  Ignored
+    directories are not descended into."""
+    if repo_dir == '.':
+        repo_dir = ''
+    if rules.ignored(repo_dir, True):
+        return
+    todo = [(dir, repo_dir)]
+    while todo:
+        dir, repo_dir = todo.pop()
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            continue
+        names.sort()
+        subdirs = []
+        for name in names:
+            if name == '.git':
+                continue
+            path = os.path.join(dir, name)
+            if repo_dir:
+                repo_path = repo_dir + '/' + name
+            else:
+                repo_path = name
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError:
+                continue
+            if stat.S_ISDIR(mode):
+                if not rules.match(repo_path, True):
+                    subdirs.append((path, repo_path))
+            elif stat.S_ISREG(mode) or stat.S_ISLNK(mode):
+                if not rules.match(repo_path, False):
+                    yield path
+        subdirs.reverse()
+        todo += subdirs
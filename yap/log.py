@@ -0,0 +1,83 @@
+import re
+
+from util import yield_output
+
+# Each commit starts with a NUL and its fields are NUL-separated; whatever
+# git prints after the last field, up to the next NUL, is the commit's diff
+FIELDS = ('hash', 'parents', 'author', 'date', 'decoration', 'message')
+FORMAT = '%x00%H%x00%p%x00%aN <%aE>%x00%ad%x00{decoration}%x00%B%x00'
+
+# The parts of a commit, in the order read_log() produces them; 'end' is the
+# blank line that separates it from the next commit
+PARTS = ('commit', 'header', 'message', 'diff', 'end')
+
+def log_command(args, color=False):
+    """Return the 'git log' command line that lists the commits selected by
+    args in the form read_log() expects"""
+    if color:
+        decoration = '%C(auto)%d'
+        args = ['--color'] + args
+    else:
+        decoration = ''
+    return ['git', 'log', '--date=local', '--cc',
+            '--format=' + FORMAT.format(decoration=decoration)] + args
+
+def _format_header(commit, color):
+    "Yield the lines 'git show' prints ahead of a commit's diff"
+    if color:
+        line = "\033[33mcommit %s\033[m%s\n"
+    else:
+        line = "commit %s%s\n"
+    yield 'commit', line % (commit['hash'], commit['decoration'])
+    parents = commit['parents'].split()
+    if len(parents) > 1:
+        yield 'header', "Merge: %s\n" % ' '.join(parents)
+    yield 'header', "Author: %s\n" % commit['author']
+    yield 'header', "Date:   %s\n" % commit['date']
+    yield 'header', "\n"
+    for l in commit['message'].rstrip('\n').split('\n'):
+        yield 'message', '    ' + l + '\n'
+
+def read_log(cmd, color=False, cwd=None):
+    """Run a command made by log_command() and yield the lines 'git show'
+    would print for each commit as (part, line) pairs, where part is one of
+    PARTS.  Diff lines are passed on as git prints them, so a commit is
+    never held in memory whole."""
+    fields = []
+    text = ''
+    in_diff = True
+    started = False
+    for line in yield_output(cmd, strip=False, cwd=cwd):
+        pieces = line.split('\0')
+        for i in xrange(len(pieces)):
+            piece = pieces[i]
+            if i:
+                # A NUL ends the field or diff before it
+                if not in_diff:
+                    fields.append(text)
+                    text = ''
+                    if len(fields) == len(FIELDS):
+                        for x in _format_header(dict(zip(FIELDS, fields)),
+                                                color):
+                            yield x
+                        in_diff = True
+                        # Drop the newline that ends the format
+                        piece = piece[1:]
+                else:
+                    if started:
+                        yield 'end', '\n'
+                    started = True
+                    in_diff = False
+                    fields = []
+            if not in_diff:
+                text += piece
+            elif piece:
+                yield 'diff', piece
+    if started:
+        yield 'end', '\n'
+
+_color = re.compile('\033\\[[0-9;]*m')
+
+def commit_hash(line):
+    "Return the hash from the 'commit' line of a commit"
+    return _color.sub('', line).split()[1]
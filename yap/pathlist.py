@@ -0,0 +1,143 @@
+from array import array
+from itertools import islice
+
+# Paths are gathered into chunks of this many before being joined, so that
+# only one chunk's worth of separate string objects exists at a time
+CHUNK = 4096
+
+# Hashing every path for the filter costs about as much as this many
+# binary searches per path
+FILTER_COST = 8
+
+class PathList(object):
+    """A sorted, read-only list of paths, stored as one string and an array
+    of offsets into it.  This takes a fraction of the memory of a list or
+    set of strings, and membership is a binary search."""
+
+    def __init__(self, paths=None):
+        "Build the list from paths, or leave it open for append() if None"
+        self.data = ''
+        self.offsets = array('L', [0])
+        self.pending = []
+        self.chunks = []
+        self.last = None
+        self.ordered = True
+        self.filter = None
+        self.lookups = 0
+        if paths is not None:
+            paths = iter(paths)
+            while True:
+                chunk = list(islice(paths, CHUNK))
+                if not chunk:
+                    break
+                self._add(chunk)
+            self.close()
+
+    def _add(self, chunk):
+        # Most input comes sorted from git; anything else is sorted and
+        # rid of duplicates by close()
+        if self.ordered and ((self.last is not None and chunk[0] <= self.last)
+                or chunk != sorted(chunk) or len(set(chunk)) != len(chunk)):
+            self.ordered = False
+        self.last = chunk[-1]
+        offsets = self.offsets
+        end = offsets[-1]
+        for n in map(len, chunk):
+            end += n
+            offsets.append(end)
+        self.chunks.append(''.join(chunk))
+
+    def append(self, path):
+        "Add a path; close() must be called before the list is read"
+        self.pending.append(path)
+        if len(self.pending) >= CHUNK:
+            self._add(self.pending)
+            self.pending = []
+
+    def close(self):
+        if self.pending:
+            self._add(self.pending)
+        self.data = ''.join(self.chunks)
+        self.pending = self.chunks = self.last = None
+        if not self.ordered:
+            self.__init__(sorted(set(self)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        data = self.data
+        offsets = self.offsets
+        for i in xrange(len(offsets) - 1):
+            yield data[offsets[i]:offsets[i + 1]]
+
+    def _build_filter(self):
+        # One hashed bit per byte of path data, at least eight per path
+        size = 64
+        while size < len(self.data) or size < len(self) * 8:
+            size *= 2
+        bits = bytearray(size >> 3)
+        mask = size - 1
+        for p in self:
+            h = hash(p) & mask
+            bits[h >> 3] |= 1 << (h & 7)
+        self.filter = bits, mask
+
+    def __contains__(self, path):
+        # Most lookups are for paths that are not there; once there have
+        # been enough to pay for it, a bit filter over the hashes answers
+        # those without a search
+        if self.filter is None:
+            self.lookups += 1
+            if self.lookups * FILTER_COST > len(self):
+                self._build_filter()
+        if self.filter is not None:
+            bits, mask = self.filter
+            h = hash(path) & mask
+            if not bits[h >> 3] & (1 << (h & 7)):
+                return False
+        data = self.data
+        offsets = self.offsets
+        lo = 0
+        hi = len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid + 1]] < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(offsets) - 1 \
+                and data[offsets[lo]:offsets[lo + 1]] == path
+
+    def __nonzero__(self):
+        return len(self.offsets) > 1
+
+    def __repr__(self):
+        return "PathList(%d paths)" % len(self)
+
+    def under(self, dir):
+        """Yield the paths below the directory dir, which are all together
+        in a sorted list"""
+        prefix = dir.rstrip('/') + '/'
+        data = self.data
+        offsets = self.offsets
+        lo = 0
+        hi = len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid + 1]] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in xrange(lo, len(offsets) - 1):
+            path = data[offsets[i]:offsets[i + 1]]
+            if not path.startswith(prefix):
+                break
+            yield path
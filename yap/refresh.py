@@ -0,0 +1,184 @@
+import os
+import stat
+import time
+import struct
+import threading
+
+from util import get_output, _record
+
+# Above this many changed-looking entries, git is asked to refresh the whole
+# index instead of matching every entry against a long list of paths
+MAX_PATHSPECS = 1000
+
+class UnsupportedIndex(Exception):
+    pass
+
+_header = struct.Struct('>4sII')
+_stat = struct.Struct('>10I')
+_flags = struct.Struct('>H')
+
+# Entry flags
+ASSUME_VALID = 0x8000
+EXTENDED = 0x4000
+STAGE_SHIFT = 12
+# Extended entry flags
+SKIP_WORKTREE = 0x4000
+
+def _varint(data, pos):
+    "Decode one of git's offset varints, as used by index version 4"
+    c = ord(data[pos])
+    pos += 1
+    value = c & 127
+    while c & 128:
+        c = ord(data[pos])
+        pos += 1
+        value = ((value + 1) << 7) | (c & 127)
+    return value, pos
+
+def read_index(path, hash_size=20):
+    """Return the entries of the index at path as (name, stat, flags,
+    extended flags) tuples, where stat is the ten stat fields git keeps:
+    ctime, ctime ns, mtime, mtime ns, dev, ino, mode, uid, gid and size."""
+    f = file(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    signature, version, count = _header.unpack_from(data, 0)
+    if signature != 'DIRC' or version not in (2, 3, 4):
+        raise UnsupportedIndex("unknown index format")
+
+    entries = []
+    pos = _header.size
+    prev = ''
+    for n in xrange(count):
+        start = pos
+        fields = _stat.unpack_from(data, pos)
+        pos += _stat.size + hash_size
+        flags, = _flags.unpack_from(data, pos)
+        pos += 2
+        xflags = 0
+        if flags & EXTENDED:
+            xflags, = _flags.unpack_from(data, pos)
+            pos += 2
+        if version == 4:
+            strip, pos = _varint(data, pos)
+            end = data.index('\0', pos)
+            name = prev[:len(prev) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index('\0', pos)
+            name = data[pos:end]
+            pos = start + ((end - start + 8) & ~7)
+        prev = name
+        entries.append((name, fields, flags, xflags))
+
+    # Entries of a split index live partly in another file
+    while pos + 8 <= len(data) - hash_size:
+        signature, size = struct.unpack_from('>4sI', data, pos)
+        if signature == 'link':
+            raise UnsupportedIndex("split index")
+        pos += 8 + size
+    return entries
+
+def _changed(fields, st):
+    "Whether st differs from the stat data git recorded for an entry"
+    ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size = fields
+    if size != st.st_size & 0xffffffff:
+        return True
+    # Python 2 only has float times, good to well under a microsecond
+    if abs(st.st_mtime - (mtime + mtime_ns * 1e-9)) > 1e-6:
+        return True
+    if abs(st.st_ctime - (ctime + ctime_ns * 1e-9)) > 1e-6:
+        return True
+    if ino != st.st_ino & 0xffffffff or uid != st.st_uid or gid != st.st_gid:
+        return True
+    if stat.S_ISLNK(st.st_mode):
+        return mode != 0120000
+    if not stat.S_ISREG(st.st_mode):
+        return True
+    return mode != (st.st_mode & 0100 and 0100755 or 0100644)
+
+def _lstat_all(top, entries, racy, threads):
+    """Stat entries on a pool of threads and return the names of those that
+    may have changed, with the total time the threads spent"""
+    chunks = [ entries[i::threads] for i in range(threads) ]
+    results = [ None ] * threads
+
+    def worker(n):
+        begin = time.time()
+        maybe = []
+        for name, fields, flags, xflags in chunks[n]:
+            # Git must look at the contents of racily clean entries and
+            # of submodules, so they always go to it
+            if fields[2] >= racy or fields[6] == 0160000:
+                maybe.append(name)
+                continue
+            try:
+                st = os.lstat(os.path.join(top, name))
+            except OSError:
+                maybe.append(name)
+                continue
+            if _changed(fields, st):
+                maybe.append(name)
+        results[n] = maybe, time.time() - begin
+
+    pool = [ threading.Thread(target=worker, args=(n,))
+                for n in range(1, threads) ]
+    for t in pool:
+        t.start()
+    worker(0)
+    for t in pool:
+        t.join()
+
+    maybe = []
+    busy = 0.0
+    for names, spent in results:
+        maybe += names
+        busy += spent
+    return maybe, busy
+
+def refresh_index(top, index, threads, hash_size=20):
+    """Refresh the stat data in index for the work tree at top, stating
+    entries on threads threads.  Only the entries whose stat data looks
+    different are handed to git.  Return the paths that still differ from
+    the index afterwards, including unmerged ones."""
+    begin = time.time()
+    racy = int(os.stat(index).st_mtime)
+    entries = []
+    unmerged = set()
+    for entry in read_index(index, hash_size):
+        name, fields, flags, xflags = entry
+        if (flags >> STAGE_SHIFT) & 3:
+            unmerged.add(name)
+        elif not (flags & ASSUME_VALID or xflags & SKIP_WORKTREE):
+            entries.append(entry)
+
+    threads = max(1, min(threads, len(entries) / 64))
+    stating = time.time()
+    maybe, busy = _lstat_all(top, entries, racy, threads)
+    stated = time.time()
+
+    changed = set(unmerged)
+    if maybe:
+        cmd = ['git', '-c', 'core.quotepath=false', '--literal-pathspecs',
+                'add', '--refresh', '--verbose']
+        if len(maybe) > MAX_PATHSPECS:
+            output = get_output(cmd + ['--', '.'], strip=False, cwd=top)
+        else:
+            cmd += ['--pathspec-from-file=-', '--pathspec-file-nul']
+            output = get_output(cmd, strip=False, cwd=top,
+                                input='\0'.join(maybe) + '\0')
+        for line in output:
+            line = line.rstrip('\n')
+            if line[1:2] == '\t':
+                changed.add(line[2:])
+
+    # The time saved is what the stat calls would have taken one by one
+    _record(['yap', 'refresh'], begin, 0, 0, entries=len(entries),
+            candidates=len(maybe), threads=threads,
+            saved=max(0.0, busy - (stated - stating)))
+    changed = list(changed)
+    changed.sort()
+    return changed
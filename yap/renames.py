@@ -0,0 +1,124 @@
+import os
+import time
+
+from util import get_output, yield_output, object_reader, _record
+
+# Only this many of the most recently indexed tips are remembered; history
+# below a forgotten tip is just read again.  Tips that are ancestors of
+# others are dropped first, so this only matters with many branches.
+MAX_TIPS = 32
+
+class RenameIndex(object):
+    """The renames made by every commit that has been indexed, kept under
+    .git/yap so that following a file back through history needs no rename
+    detection.  A commit's renames are those against its first parent."""
+
+    def __init__(self, git_dir):
+        dir = os.path.join(git_dir, 'yap')
+        self.file = os.path.join(dir, 'renames')
+        self.tips_file = os.path.join(dir, 'renames.tips')
+        self.renames = None
+        self.sources = None
+        self.tips = None
+
+    def _load(self):
+        self.renames = {}
+        self.sources = {}
+        try:
+            data = open(self.file, 'rb').read()
+        except IOError:
+            data = ''
+        # Records are commit, new path and old path, each ended by a NUL;
+        # a partly written record at the end is ignored
+        fields = data.split('\0')
+        for i in xrange(0, len(fields) - 3, 3):
+            self._add(fields[i], fields[i + 1], fields[i + 2])
+
+        self.tips = []
+        try:
+            for line in open(self.tips_file):
+                tip = line.strip()
+                # Commits that are gone, say after a rebase, would stop
+                # git log from running at all
+                if tip and object_reader().info(tip) is not None:
+                    self.tips.append(tip)
+        except IOError:
+            pass
+
+    def update(self, rev):
+        "Index the commits reachable from the commit rev that are not yet"
+        if self.renames is None:
+            self._load()
+        if rev in self.tips:
+            return
+
+        start = time.time()
+        cmd = ['git', 'log', '-z', '--format=%x01%H', '--name-status', '-M',
+                '--diff-merges=first-parent', '--diff-filter=R', rev]
+        if self.tips:
+            cmd += ['--not'] + self.tips
+        new = []
+        commit = None
+        pending = None
+        for field in yield_output(cmd, null=True):
+            if pending is not None:
+                pending.append(field)
+                if len(pending) == 2:
+                    new.append((commit, pending[1], pending[0]))
+                    pending = None
+            elif field.startswith('\1'):
+                commit = field[1:]
+            elif field.lstrip('\n').startswith('R'):
+                pending = []
+
+        # History below a tip that was forgotten or has gone away is read
+        # again; what it finds must not be written twice
+        new = [ x for x in new if (x[0], x[1]) not in self.renames ]
+        if new:
+            dir = os.path.dirname(self.file)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+            f = open(self.file, 'ab')
+            f.write(''.join([ '%s\0%s\0%s\0' % x for x in new ]))
+            f.close()
+            for commit, path, source in new:
+                self._add(commit, path, source)
+
+        tips = [rev] + self.tips
+        # Everything below a tip is indexed, so a tip that another one
+        # leads to adds nothing
+        independent = set(get_output(['git', 'merge-base', '--independent']
+                                     + tips, quiet=True))
+        if independent:
+            tips = [ x for x in tips if x in independent ]
+        self.tips = tips[:MAX_TIPS]
+        self._save_tips()
+        _record(['yap', 'renames'], start, 0, 0, renames=len(new))
+
+    def _add(self, commit, path, source):
+        if (commit, path) not in self.renames:
+            self.renames[commit, path] = source
+            self.sources.setdefault(path, []).append(commit)
+
+    def _save_tips(self):
+        dir = os.path.dirname(self.tips_file)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        tmp = '%s.%d' % (self.tips_file, os.getpid())
+        f = open(tmp, 'w')
+        f.write(''.join([ x + '\n' for x in self.tips ]))
+        f.close()
+        os.rename(tmp, self.tips_file)
+
+    def source(self, commit, path):
+        """Return the repository-relative path that path had before commit
+        renamed it, or None"""
+        if self.renames is None:
+            self._load()
+        return self.renames.get((commit, path))
+
+    def renamed_to(self, path):
+        "Return the commits that renamed some other file to path"
+        if self.renames is None:
+            self._load()
+        return self.sources.get(path, [])
@@ -0,0 +1,119 @@
+import os
+
+from util import yield_output
+from context import repo_context
+from pathlist import PathList
+
+class StatusSnapshot(object):
+    "The staged, unstaged and unmerged files of a repository at one moment"
+
+    def __init__(self, index, scope=None):
+        self.index = index
+        self.scope = scope
+        self.key = None
+        self.staged = PathList([])
+        self.unstaged = PathList([])
+        self.unmerged = PathList([])
+
+    def is_current(self):
+        "True if the index has not been rewritten since the snapshot"
+        return self.key is not None and self.key == index_key(self.index)
+
+    def refresh(self):
+        staged = PathList()
+        unstaged = PathList()
+        unmerged = PathList()
+        cmd = ['git', 'status', '--porcelain=v2', '-z', '--no-renames',
+                '--untracked-files=no', '--'] + pathspecs(self.scope)
+        # A failure must not pass for a clean tree
+        for entry in yield_output(cmd, null=True, check=True):
+            if entry.startswith('1 '):
+                fields = entry.split(' ', 8)
+                xy = fields[1]
+                if xy[0] != '.':
+                    staged.append(fields[8])
+                if xy[1] != '.':
+                    unstaged.append(fields[8])
+            elif entry.startswith('u '):
+                unmerged.append(entry.split(' ', 10)[10])
+        staged.close()
+        unstaged.close()
+        unmerged.close()
+
+        self.staged = staged
+        self.unstaged = unstaged
+        self.unmerged = unmerged
+        # git status may have refreshed the index; key on what it left
+        self.key = index_key(self.index)
+
+def pathspecs(scope):
+    """Return pathspecs naming the repository-relative paths in scope,
+    whatever the current directory, or the whole tree if scope is None"""
+    if scope is None:
+        return [':/']
+    return [ ':(top,literal)' + x for x in scope ]
+
+def in_scope(paths, scope):
+    "Return the paths that are in scope or below a directory in it"
+    if scope is None:
+        return list(paths)
+    dirs = tuple([ x + '/' for x in scope ])
+    scope = set(scope)
+    return [ x for x in paths if x in scope or x.startswith(dirs) ]
+
+def index_key(index):
+    try:
+        st = os.stat(index)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_ctime, st.st_size
+
+def index_path():
+    "Return the absolute path of the index used from the current directory"
+    if 'GIT_INDEX_FILE' in os.environ:
+        return os.path.abspath(os.environ['GIT_INDEX_FILE'])
+    gitdir = repo_context().git_dir() or '.git'
+    return os.path.abspath(os.path.join(gitdir, 'index'))
+
+_snapshots = {}
+def status_snapshot(scope=None):
+    """Return an up-to-date StatusSnapshot for the repository containing
+    the current directory, covering only the paths in scope if it is not
+    None.  The snapshot is shared by every caller and is only rebuilt
+    once the index changes."""
+    if scope is not None:
+        scope = tuple(scope)
+    key = os.getcwd(), scope
+    snapshot = _snapshots.get(key)
+    if snapshot is None:
+        snapshot = StatusSnapshot(index_path(), scope)
+        _snapshots[key] = snapshot
+    if not snapshot.is_current():
+        snapshot.refresh()
+    return snapshot
+
+def forget_snapshot():
+    "Drop the snapshots for the current directory, for long-lived callers"
+    cwd = os.getcwd()
+    for key in _snapshots.keys():
+        if key[0] == cwd:
+            del _snapshots[key]
+
+_tracked = {}
+def tracked_files(scope=None):
+    """Return a PathList of the repository-relative paths in the index,
+    or of those in scope, read with a single ls-files run and reused
+    until the index changes."""
+    if scope is not None:
+        scope = tuple(scope)
+    index = index_path()
+    key = index_key(index)
+    cached = _tracked.get((index, scope))
+    if cached is not None and key is not None and cached[0] == key:
+        return cached[1]
+
+    files = PathList(yield_output(['git', 'ls-files', '-z', '--cached',
+                                    '--full-name', '--'] + pathspecs(scope),
+                                  null=True))
+    _tracked[index, scope] = key, files
+    return files
@@ -1,36 +1,340 @@
 import yap
 import os
-import subprocess
+import sys
+import time
 
-def get_output(cmd, strip=True):
-    fd = os.popen(cmd)
-    output = fd.readlines()
-    rc = fd.close()
+_devnull = None
+def _get_devnull():
+    global _devnull
+    if _devnull is None:
+        _devnull = open(os.devnull, 'r+')
+    return _devnull
+
+def _spawn(cmd, stdin=None, stdout=None, stderr=None, cwd=None):
+    """Start cmd.  An argument list is executed directly, without a shell;
+    a plain string is still handed to /bin/sh for older plugins."""
+    import subprocess
+    shell = isinstance(cmd, basestring)
+    return subprocess.Popen(cmd, shell=shell, stdin=stdin, stdout=stdout,
+            stderr=stderr, cwd=cwd)
+
+_trace_events = None
+_trace_file = None
+
+def start_trace():
+    "Keep a record of every command run from here on; see trace_events()"
+    global _trace_events
+    if _trace_events is None:
+        _trace_events = []
+
+def trace_events():
+    "Return the commands recorded since start_trace() was called"
+    return list(_trace_events or [])
+
+def _open_trace_file():
+    global _trace_file
+    path = os.getenv('YAP_TRACE')
+    if not path:
+        _trace_file = False
+    elif path == '-':
+        _trace_file = sys.stderr
+    else:
+        try:
+            _trace_file = open(path, 'a')
+        except IOError:
+            _trace_file = False
+    return _trace_file
+
+def _caller():
+    """Return the name of the YapCore method that started a command and the
+    file:line it was started from."""
+    here = _caller.func_code.co_filename
+    f = sys._getframe(1)
+    site = None
+    while f is not None:
+        code = f.f_code
+        if code.co_filename != here:
+            line = "%s:%d" % (os.path.basename(code.co_filename), f.f_lineno)
+            if isinstance(f.f_locals.get('self'), yap.YapCore):
+                return code.co_name, line
+            if site is None:
+                site = line
+        f = f.f_back
+    return None, site
+
+def _record(cmd, start, rc, nbytes, **extra):
+    trace = _trace_file
+    if trace is None:
+        trace = _open_trace_file()
+    if _trace_events is None and not trace:
+        return
+
+    method, site = _caller()
+    if isinstance(cmd, basestring):
+        argv = cmd
+    else:
+        argv = list(cmd)
+    event = dict(argv=argv, start=start, wall=time.time() - start, rc=rc,
+            bytes=nbytes, method=method, site=site, pid=os.getpid())
+    event.update(extra)
+    if _trace_events is not None:
+        _trace_events.append(event)
+    if trace:
+        import json
+        trace.write(json.dumps(event) + '\n')
+        trace.flush()
+
+def _split_output(output, strip, null):
+    if null:
+        records = output.split('\0')
+        if records and not records[-1]:
+            records.pop()
+        return records
+
+    lines = output.split('\n')
+    last = lines.pop()
     if strip:
-        output = [x.strip() for x in output]
-    return output
+        lines = [ x.strip() for x in lines ]
+    else:
+        lines = [ x + '\n' for x in lines ]
+    if last:
+        if strip:
+            last = last.strip()
+        lines.append(last)
+    return lines
 
-def yield_output(cmd):
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+def get_output(cmd, strip=True, null=False, quiet=False, cwd=None, input=None,
+               check=False):
+    """Run cmd and return its output as a list of lines, or as a list of
+    records if null is set and the output is NUL-delimited.  If quiet is
+    set, anything cmd prints to stderr is discarded.  If check is set,
+    ShellError is raised if cmd fails."""
+    import subprocess
+    if input is None:
+        stdin = None
+    else:
+        stdin = subprocess.PIPE
+    if quiet:
+        stderr = _get_devnull()
+    else:
+        stderr = None
+    start = time.time()
+    p = _spawn(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr,
+            cwd=cwd)
+    output = p.communicate(input)[0]
+    _record(cmd, start, p.returncode, len(output))
+    if check and p.returncode:
+        raise yap.ShellError(cmd, p.returncode)
+    return _split_output(output, strip, null)
+
+def yield_output(cmd, strip=True, null=False, quiet=False, cwd=None,
+                 check=False):
+    """Like get_output, but produce each line or record as it is read.  If
+    check is set, ShellError is raised once the output is read if cmd
+    failed."""
+    import subprocess
+    if quiet:
+        stderr = _get_devnull()
+    else:
+        stderr = None
+    start = time.time()
+    nbytes = 0
+    p = _spawn(cmd, stdout=subprocess.PIPE, stderr=stderr, cwd=cwd)
     fd = p.stdout
+    if null:
+        sep = '\0'
+    else:
+        sep = '\n'
+    try:
+        # os.read() returns whatever the command has written so far, so
+        # records reach the caller as they are produced, without the pipe
+        # being read a byte at a time
+        pending = ''
+        while True:
+            data = os.read(fd.fileno(), 65536)
+            if not data:
+                break
+            nbytes += len(data)
+            records = (pending + data).split(sep)
+            pending = records.pop()
+            for r in records:
+                if null:
+                    yield r
+                elif strip:
+                    yield r.strip()
+                else:
+                    yield r + '\n'
+        if pending:
+            if strip and not null:
+                pending = pending.strip()
+            yield pending
+    finally:
+        fd.close()
+        p.wait()
+        _record(cmd, start, p.returncode, nbytes)
+    if check and p.returncode:
+        raise yap.ShellError(cmd, p.returncode)
+
+class ObjectReader(object):
+    "A long-lived 'git cat-file' co-process for looking up objects"
+
+    def __init__(self):
+        self.batch = None
+        self.check = None
+
+    def _start(self, mode):
+        import subprocess
+        cmd = ['git', 'cat-file', mode]
+        start = time.time()
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=_get_devnull(), bufsize=-1)
+        # The co-process outlives the caller; only its start-up is timed
+        _record(cmd, start, None, 0)
+        return p
+
+    def _query(self, p, obj):
+        if '\n' in obj:
+            return None
+        try:
+            p.stdin.write(obj + '\n')
+            p.stdin.flush()
+            header = p.stdout.readline()
+        except IOError:
+            return None
+        # The name is echoed back when it is not found, and it may itself
+        # contain spaces
+        fields = header.rstrip('\n').rsplit(' ', 2)
+        if len(fields) != 3 or fields[-1] in ('missing', 'ambiguous'):
+            return None
+        if not fields[2].isdigit():
+            return None
+        return fields[0], fields[1], int(fields[2])
 
-    for l in fd.xreadlines():
-        yield l.strip()
-    return
+    def info(self, obj):
+        "Return (hash, type, size) for obj, or None if it does not exist"
+        if self.check is None:
+            self.check = self._start('--batch-check')
+        return self._query(self.check, obj)
+
+    def read(self, obj):
+        "Return (hash, type, contents) for obj, or None if it does not exist"
+        if self.batch is None:
+            self.batch = self._start('--batch')
+        info = self._query(self.batch, obj)
+        if info is None:
+            return None
+        hash, type, size = info
+        data = self.batch.stdout.read(size)
+        self.batch.stdout.read(1)
+        return hash, type, data
+
+    def type(self, obj):
+        info = self.info(obj)
+        if info is None:
+            return None
+        return info[1]
+
+    def size(self, obj):
+        info = self.info(obj)
+        if info is None:
+            return None
+        return info[2]
+
+    def contents(self, obj):
+        data = self.read(obj)
+        if data is None:
+            return None
+        return data[2]
+
+    def close(self):
+        for p in self.batch, self.check:
+            if p is None:
+                continue
+            p.stdin.close()
+            p.wait()
+        self.batch = None
+        self.check = None
+
+_object_readers = {}
+def object_reader():
+    "Return the ObjectReader shared by everything running in this directory"
+    cwd = os.getcwd()
+    if cwd not in _object_readers:
+        _object_readers[cwd] = ObjectReader()
+    return _object_readers[cwd]
+
+def find_program(name):
+    "Return the path of the program name would run, or None"
+    for dir in os.getenv('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dir or '.', name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+_stdout_tty = None
+def set_stdout_tty(tty):
+    "Override whether stdout counts as a terminal; None to ask the system"
+    global _stdout_tty
+    _stdout_tty = tty
 
 def stdout_is_tty():
+    if _stdout_tty is not None:
+        return _stdout_tty
     return os.isatty(1)
 
-def run_command(cmd):
-    rc = os.system("%s > /dev/null 2>&1" % cmd)
-    rc >>= 8
-    return rc
+def run_command(cmd, cwd=None, input=None, stdout=None):
+    """Run cmd and return its exit status.  Its output is discarded unless
+    a file is given to send stdout to."""
+    import subprocess
+    devnull = _get_devnull()
+    if input is None:
+        stdin = None
+    else:
+        stdin = subprocess.PIPE
+    if stdout is None:
+        stdout = devnull
+    start = time.time()
+    p = _spawn(cmd, stdin=stdin, stdout=stdout, stderr=devnull, cwd=cwd)
+    p.communicate(input)
+    _record(cmd, start, p.returncode, 0)
+    return p.returncode
 
-def run_safely(cmd):
-    rc = run_command(cmd)
+def run_safely(cmd, cwd=None, input=None, stdout=None):
+    rc = run_command(cmd, cwd, input, stdout)
     if rc:
 	raise yap.ShellError(cmd, rc)
 
+def run_interactive(cmd, cwd=None):
+    "Run cmd attached to the terminal and return its exit status"
+    start = time.time()
+    p = _spawn(cmd, cwd=cwd)
+    rc = p.wait()
+    _record(cmd, start, rc, 0)
+    return rc
+
+def run_background(cmd, cwd=None):
+    """Start cmd in its own session, with its output discarded, and return
+    its pid without waiting for it"""
+    import subprocess
+    devnull = _get_devnull()
+    start = time.time()
+    p = subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+            cwd=cwd, close_fds=True, preexec_fn=os.setsid)
+    _record(cmd, start, None, 0)
+    return p.pid
+
+def run_paged(cmd, pager, cwd=None):
+    "Run cmd with its output sent through the pager command line"
+    import subprocess
+    start = time.time()
+    pager = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE)
+    p = _spawn(cmd, stdout=pager.stdin, cwd=cwd)
+    pager.stdin.close()
+    rc = p.wait()
+    pager.wait()
+    _record(cmd, start, rc, 0)
+    return rc
+
 def takes_options(options):
     def decorator(func):
         func.options = options
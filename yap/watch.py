@@ -0,0 +1,216 @@
+import os
+import time
+import errno
+import struct
+import threading
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 02000000
+IN_NONBLOCK = 04000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+        | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+        | IN_MOVE_SELF | IN_ONLYDIR | IN_DONTFOLLOW | IN_EXCL_UNLINK)
+
+# Past this many distinct dirty paths, tokens are reset and callers fall
+# back to a full scan rather than the watcher holding on to them all
+MAX_CHANGES = 100000
+
+class WatchError(Exception):
+    pass
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        name = ctypes.util.find_library('c') or 'libc.so.6'
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+def _errno():
+    import ctypes
+    return ctypes.get_errno()
+
+class Watcher(object):
+    """Records which paths below a work tree have changed, using inotify.
+
+    Every batch of changes is numbered.  A token names the watcher and a
+    number, and changed_since() lists the paths touched after it.  Tokens
+    from another watcher, or from before an event queue overflow, cannot
+    be answered and mean that the caller must look at everything.  So can
+    no token at all once a new directory could not be watched; the
+    watcher is then degraded for the rest of its life."""
+
+    def __init__(self, top):
+        self.top = os.path.abspath(top)
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.changes = {}
+        self.seq = 0
+        self.fd = -1
+        self.degraded = None
+
+        try:
+            libc = _get_libc()
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError), e:
+            raise WatchError("inotify is not available: %s" % e)
+        if self.fd < 0:
+            raise WatchError("inotify_init1: %s" % os.strerror(_errno()))
+        self._reset()
+        self._watch_tree('')
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _reset(self):
+        # A new epoch invalidates every token handed out so far
+        self.epoch = "%d.%d" % (os.getpid(), int(time.time() * 1000000))
+        self.changes = {}
+
+    def _watch_tree(self, rel):
+        "Watch rel and every directory below it except .git"
+        libc = _get_libc()
+        todo = [rel]
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.top, rel)
+            wd = libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+            if wd < 0:
+                err = _errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise WatchError("cannot watch %s: %s"
+                        % (path, os.strerror(err)))
+            self.dirs[wd] = rel
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                if name == '.git':
+                    continue
+                child = os.path.join(rel, name)
+                if os.path.isdir(os.path.join(self.top, child)) \
+                        and not os.path.islink(os.path.join(self.top, child)):
+                    todo.append(child)
+
+    def _watch_new_tree(self, rel):
+        # Changes below a directory that is not watched would go unseen,
+        # say once fs.inotify.max_user_watches is reached
+        if self.degraded is not None:
+            return
+        try:
+            self._watch_tree(rel)
+        except WatchError, e:
+            self.degraded = str(e)
+            self._reset()
+
+    def _read(self):
+        chunks = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def _dirty(self, path):
+        self.changes[path] = self.seq
+        if len(self.changes) > MAX_CHANGES:
+            self._reset()
+
+    def drain(self):
+        "Take in every event the kernel has queued"
+        self.lock.acquire()
+        try:
+            data = self._read()
+            if not data:
+                return
+            self.seq += 1
+            pos = 0
+            while pos + 16 <= len(data):
+                wd, mask, cookie, size = struct.unpack('iIII',
+                        data[pos:pos + 16])
+                name = data[pos + 16:pos + 16 + size].rstrip('\0')
+                pos += 16 + size
+
+                if mask & IN_Q_OVERFLOW:
+                    self._reset()
+                    continue
+                dir = self.dirs.get(wd)
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                if dir is None:
+                    continue
+                if not name:
+                    # The directory itself went away or moved
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and dir:
+                        self._dirty(dir + '/')
+                    continue
+                if not dir and name == '.git':
+                    continue
+
+                path = os.path.join(dir, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_new_tree(path)
+                    if mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM
+                                | IN_DELETE):
+                        self._dirty(path + '/')
+                    continue
+                self._dirty(path)
+        finally:
+            self.lock.release()
+
+    def token(self):
+        "Return a token naming the present moment"
+        self.drain()
+        self.lock.acquire()
+        try:
+            # Later events must get a larger number than this token
+            self.seq += 1
+            return "yap:%s:%d" % (self.epoch, self.seq)
+        finally:
+            self.lock.release()
+
+    def changed_since(self, token):
+        """Return the paths changed after token, relative to the top of the
+        tree (directories end in '/'), or None if token is unknown."""
+        self.drain()
+        try:
+            tag, epoch, seq = token.split(':')
+            seq = int(seq)
+        except ValueError:
+            return None
+        self.lock.acquire()
+        try:
+            if tag != 'yap' or epoch != self.epoch or self.degraded:
+                return None
+            return [ p for p, s in self.changes.items() if s >= seq ]
+        finally:
+            self.lock.release()
@@ -1,11 +1,13 @@
 import sys
 import os
-import glob
+import errno
 import getopt
-import pickle
-import tempfile
+import time
 
 from util import *
+from status import status_snapshot, tracked_files, pathspecs, in_scope
+from pathlist import PathList
+from context import repo_context
 
 class ShellError(Exception):
     def __init__(self, cmd, rc):
@@ -13,7 +15,10 @@ class ShellError(Exception):
 	self.rc = rc
 
     def __str__(self):
-	return "%s returned %d" % (self.cmd, self.rc)
+	cmd = self.cmd
+	if not isinstance(cmd, basestring):
+	    cmd = ' '.join(cmd)
+	return "%s returned %d" % (cmd, self.rc)
 
 class YapError(Exception):
     def __init__(self, msg):
@@ -22,149 +27,220 @@ class YapError(Exception):
     def __str__(self):
         return self.msg
 
+_command_tables = {}
+
+# At most this many changed-path filters are computed by the commit-graph
+# write after a commit, fetch or update; commits beyond it are still in the
+# graph, just without a filter
+MAX_NEW_FILTERS = 1000
+
 class YapCore(object):
-    def _add_new_file(self, file):
-        repo = get_output('git rev-parse --git-dir')[0]
-        dir = os.path.join(repo, 'yap')
+    def _new_files_path(self):
+        repo = self._get_git_dir()
+        return os.path.join(repo, 'yap', 'new-files')
+
+    def _save_new_files(self, files):
+        import pickle
+        path = self._new_files_path()
         try:
-            os.mkdir(dir)
+            os.mkdir(os.path.dirname(path))
         except OSError:
             pass
-        files = self._get_new_files()
-        files.append(file)
-        path = os.path.join(dir, 'new-files')
         pickle.dump(files, open(path, 'w'))
 
-    def _get_new_files(self):
-        repo = get_output('git rev-parse --git-dir')[0]
-        path = os.path.join(repo, 'yap', 'new-files')
+    def _get_new_files(self, scope=None):
+        import pickle
+        path = self._new_files_path()
         try:
             files = pickle.load(file(path))
         except IOError:
             files = []
+        files = in_scope(files, scope)
+        if not files:
+            return files
 
-        x = []
+        # Drop anything that has since made it into the index
+        tracked = tracked_files(scope)
+        return [ x for x in files if x not in tracked ]
+
+    def _add_new_files(self, files):
+        current = self._get_new_files()
+        known = set(current)
         for f in files:
-            # if f in the index
-            if get_output("git ls-files --cached '%s'" % f) != []:
+            if f in known:
                 continue
-            x.append(f)
-        return x
+            known.add(f)
+            current.append(f)
+        self._save_new_files(current)
+
+    def _remove_new_files(self, files):
+        files = set(files)
+        current = self._get_new_files()
+        remaining = [ x for x in current if x not in files ]
+        if len(remaining) == len(current):
+            return
+        try:
+            self._save_new_files(remaining)
+        except IOError:
+            pass
 
-    def _remove_new_file(self, file):
-        files = self._get_new_files()
-        files = filter(lambda x: x != file, files)
+    def _add_new_file(self, file):
+        self._add_new_files([file])
 
-        repo = get_output('git rev-parse --git-dir')[0]
-        path = os.path.join(repo, 'yap', 'new-files')
-	try:
-	    pickle.dump(files, open(path, 'w'))
-	except IOError:
-	    pass
+    def _remove_new_file(self, file):
+        self._remove_new_files([file])
 
     def _assert_file_exists(self, file):
         if not os.access(file, os.R_OK):
             raise YapError("No such file: %s" % file)
 
     def _repo_path_to_rel(self, path):
-        prefix = get_output("git rev-parse --show-prefix")
-        if not prefix:
-            return path
+        return self._repo_paths_to_rel([path])[0]
 
-	prefix = [ prefix[0] ]
-	while True:
-	    head, tail = os.path.split(prefix[0])
-	    if not head:
-		break
-	    prefix[0] = head
-	    if tail:
-		prefix.insert(1, tail)
-
-	path = [ path ]
-	while True:
-	    head, tail = os.path.split(path[0])
-	    if not head:
-		break
-	    path[0] = head
-	    if tail:
-		path.insert(1, tail)
-
-        common = 0
-        for a, b in zip(prefix, path):
-            if a != b:
-                break
-            common += 1
-
-        path = path[common:]
-        cdup = [".."] * (len(prefix) - common)
-        path = cdup + list(path)
-        path = os.path.join(*path)
-        return path
-
-    def _get_staged_files(self):
-        if run_command("git rev-parse HEAD"):
-            files = get_output("git ls-files --full-name --cached")
+    def _repo_paths_to_rel(self, paths):
+        "Convert repository-relative paths to paths relative to the cwd"
+        prefix = self._get_prefix()
+        if not prefix:
+            # Nothing to convert, so a PathList is not copied into a list
+            return paths
+
+        # git's prefix is normalized and ends in '/', so most paths below
+        # the cwd only need it sliced off
+        size = len(prefix)
+        parts = prefix.rstrip('/').split('/')
+        result = []
+        for path in paths:
+            if path.startswith(prefix):
+                result.append(path[size:])
+                continue
+            path = path.split('/')
+            common = 0
+            for a, b in zip(parts, path):
+                if a != b:
+                    break
+                common += 1
+            path = [".."] * (len(parts) - common) + path[common:]
+            if not path:
+                path = ["."]
+            result.append(os.path.join(*path))
+        return result
+
+    def _rel_paths_to_repo(self, files):
+        "Convert paths relative to the cwd to repository-relative paths"
+        prefix = self._get_prefix()
+        if prefix:
+            return [ os.path.normpath(os.path.join(prefix, x)) for x in files ]
+        return [ os.path.normpath(x) for x in files ]
+
+    def _print_files(self, files):
+        "Print a status section of repository-relative paths"
+        if not files:
+            print "\t(none)"
+            return
+        sys.stdout.write("".join([ "\t%s\n" % x
+                                for x in self._repo_paths_to_rel(files) ]))
+
+    def _get_scope(self, paths=()):
+        """Return the repository-relative paths a command is limited to: the
+        given paths, else the current directory if yap.scopeToCwd is set.
+        None means the whole repository."""
+        if paths:
+            scope = self._rel_paths_to_repo(paths)
+            for f, path in zip(paths, scope):
+                if path == '..' or path.startswith(('../', '/')):
+                    raise YapError("Not in the repository: %s" % f)
+                # A tracked file that has been deleted is still in scope
+                if not os.path.lexists(f) and not tracked_files([path]):
+                    raise YapError("No such file: %s" % f)
+        elif self._get_config_bool("yap.scopeToCwd"):
+            scope = [ os.path.normpath(self._get_prefix() or '.') ]
         else:
-            files = get_output("git diff-index --cached --name-only HEAD")
-	unmerged = self._get_unmerged_files()
-	if unmerged:
-	    unmerged = set(unmerged)
-	    files = set(files).difference(unmerged)
-	    files = list(files)
+            return None
+        if '.' in scope:
+            return None
+        return scope
+
+    def _get_status(self, scope=None):
+        return status_snapshot(scope)
+
+    def _get_staged_files(self, scope=None):
+        return self._get_status(scope).staged
+
+    def _get_unstaged_files(self, scope=None):
+        status = self._get_status(scope)
+        files = status.unstaged
+        new_files = [ x for x in self._get_new_files(scope)
+                      if x not in status.staged ]
+        if status.unmerged:
+            files = PathList(x for x in files if x not in status.unmerged)
+            new_files = [ x for x in new_files if x not in status.unmerged ]
+        if new_files:
+            # New files are listed after the changed ones
+            files = list(files) + new_files
         return files
 
-    def _get_unstaged_files(self):
-        cwd = os.getcwd()
-	cdup = self._get_cdup()
-	os.chdir(cdup)
-        files = get_output("git ls-files -m")
-        os.chdir(cwd)
+    def _get_unmerged_files(self, scope=None):
+        return self._get_status(scope).unmerged
 
-        new_files = self._get_new_files()
-        if new_files:
-            staged = self._get_staged_files()
-            if staged:
-                staged = set(staged)
-                new_files = set(new_files).difference(staged)
-                new_files = list(new_files)
-            files += new_files
-	unmerged = self._get_unmerged_files()
-	if unmerged:
-	    unmerged = set(unmerged)
-	    files = set(files).difference(unmerged)
-	    files = list(files)
-        return files
+    def _objects(self):
+        return object_reader()
 
-    def _get_unmerged_files(self):
-        cwd = os.getcwd()
-	cdup = self._get_cdup()
-	os.chdir(cdup)
-	files = get_output("git ls-files -u")
-        os.chdir(cwd)
-	files = [ x.replace('\t', ' ').split(' ')[3] for x in files ]
-	return list(set(files))
+    def _ancestry(self):
+        import ancestry
+        return ancestry.ancestry()
+
+    def _get_context(self):
+        return repo_context()
+
+    def _get_git_dir(self):
+        return self._get_context().git_dir()
+
+    def _get_prefix(self):
+        return self._get_context().prefix()
+
+    def _get_head(self):
+        return self._get_context().head()
+
+    def _set_head(self, ref):
+        if self._get_context().set_head(ref):
+            raise ShellError("git symbolic-ref HEAD %s" % ref, 1)
+
+    def _get_config(self, key, default=None):
+        return self._get_context().config(key, default)
+
+    def _get_config_bool(self, key, default=False):
+        try:
+            return self._get_context().config_bool(key, default)
+        except ValueError:
+            raise YapError("%s is not a boolean: %s"
+                    % (key, self._get_config(key)))
+
+    def _set_config(self, key, value):
+        return self._get_context().set_config(key, value)
+
+    def _unset_config(self, key):
+        return self._get_context().unset_config(key)
 
     def _resolve_rev(self, rev):
-        ref = get_output("git rev-parse --verify %s 2>/dev/null" % rev)
-        if not ref:
+        ref = self._objects().info(rev)
+        if ref is None:
             raise YapError("No such revision: %s" % rev)
         return ref[0]
 
     def _delete_branch(self, branch, force):
-        current = get_output("git symbolic-ref HEAD")
+        current = self._get_head()
 	if current:
-	    current = current[0].replace('refs/heads/', '')
+	    current = current.replace('refs/heads/', '')
 	    if branch == current:
 		raise YapError("Can't delete current branch")
 
         ref = self._resolve_rev('refs/heads/'+branch)
-        run_safely("git update-ref -d 'refs/heads/%s' '%s'" % (branch, ref))
+        if not force and not self._ancestry().reachable(ref,
+                                        exclude=['refs/heads/%s' % branch]):
+            raise YapError("Refusing to delete leaf branch (use -f to force)")
 
-        if not force:
-            name = get_output("git name-rev --name-only '%s'" % ref)[0]
-            if name == 'undefined':
-                run_command("git update-ref 'refs/heads/%s' '%s'" % (branch, ref))
-                raise YapError("Refusing to delete leaf branch (use -f to force)")
+        run_safely(['git', 'update-ref', '-d', 'refs/heads/%s' % branch, ref])
+        self._ancestry().forget_refs()
     def _get_pager_cmd(self):
         if 'YAP_PAGER' in os.environ:
             pager = os.environ['YAP_PAGER']
@@ -183,62 +259,139 @@ class YapCore(object):
 
 	return pager
 
+    def _add_files(self, files):
+        for f in files:
+            self._assert_file_exists(f)
+	files = self._rel_paths_to_repo(files)
+
+        tracked = tracked_files()
+        new_files = set(self._get_new_files())
+        for f in files:
+            if f in tracked or f in new_files:
+                raise YapError("File '%s' already in repository" % f)
+        self._add_new_files(files)
+
     def _add_one(self, file):
-        self._assert_file_exists(file)
-        x = get_output("git ls-files '%s'" % file)
-	prefix = get_output("git rev-parse --show-prefix")
-	if prefix:
-	    file = os.path.join(prefix[0], file)
-        if x != [] or file in self._get_new_files():
-            raise YapError("File '%s' already in repository" % file)
-        self._add_new_file(file)
+        self._add_files([file])
+
+    def _rm_files(self, files):
+        for f in files:
+            self._assert_file_exists(f)
+	paths = self._rel_paths_to_repo(files)
+        tracked = tracked_files()
+        remove = [ f for f, path in zip(files, paths) if path in tracked ]
+        if remove:
+            run_safely(['git', '--literal-pathspecs', 'rm', '--cached',
+                        '--pathspec-from-file=-', '--pathspec-file-nul'],
+                        input='\0'.join(remove) + '\0')
+        self._remove_new_files(paths)
 
     def _rm_one(self, file):
-        self._assert_file_exists(file)
-        if get_output("git ls-files '%s'" % file) != []:
-            run_safely("git rm --cached '%s'" % file)
-        self._remove_new_file(file)
+        self._rm_files([file])
+
+    def _stage_files(self, files, allow_unmerged=False):
+        files = list(files)
+        if not files:
+            return
+        for f in files:
+            self._assert_file_exists(f)
+
+        if not allow_unmerged:
+            unmerged = self._get_status().unmerged
+            if unmerged:
+                paths = self._rel_paths_to_repo(files)
+                for f, path in zip(files, paths):
+                    if path in unmerged:
+                        raise YapError("Refusing to stage conflicted file: %s" % f)
+
+        cmd = ['git', 'update-index', '--add', '-z', '--stdin']
+        run_safely(cmd, input='\0'.join(files) + '\0')
 
     def _stage_one(self, file, allow_unmerged=False):
-        self._assert_file_exists(file)
-	prefix = get_output("git rev-parse --show-prefix")
-	if prefix:
-	    tmp = os.path.normpath(os.path.join(prefix[0], file))
-	else:
-	    tmp = file
-	if not allow_unmerged and tmp in self._get_unmerged_files():
-	    raise YapError("Refusing to stage conflicted file: %s" % file)
-        run_safely("git update-index --add '%s'" % file)
+        self._stage_files([file], allow_unmerged)
+
+    def _stage_new_files(self, scope=None):
+        "Stage everything in the new-files registry, or just what is in scope"
+        files = self._get_new_files(scope)
+        if not files:
+            return
+        cdup = self._get_cdup()
+        self._stage_files([ os.path.join(cdup, x) for x in files ])
 
     def _get_cdup(self):
-	cdup = get_output("git rev-parse --show-cdup")
-	assert cdup
-	if cdup[0]:
-	    cdup = cdup[0]
-	else:
+	cdup = self._get_context().cdup()
+	assert cdup is not None
+	if not cdup:
 	    cdup = '.'
 	return cdup
 
-    def _unstage_one(self, file):
-        self._assert_file_exists(file)
-        if run_command("git rev-parse HEAD"):
-            rc = run_command("git update-index --force-remove '%s'" % file)
+    def _unstage_paths(self, paths):
+        "Reset the index entries of repository-relative paths to HEAD"
+        paths = set(paths)
+        if not paths:
+            return
+        if self._objects().info("HEAD") is None:
+            cmd = ['git', 'update-index', '--force-remove', '-z', '--stdin']
+            cdup = self._get_cdup()
+            input = [ os.path.join(cdup, x) for x in paths ]
         else:
-	    cdup = self._get_cdup()
-            rc = run_command("git diff-index --cached -p HEAD '%s' | (cd %s; git apply -R --cached)" % (file, cdup))
+            # Raw diff lines carry HEAD's mode and blob for each path
+            cmd = ['git', 'update-index', '-z', '--index-info']
+            input = []
+            diff = yield_output(['git', 'diff-index', '--cached', '-z',
+                                '--no-renames', 'HEAD'], null=True)
+            for info in diff:
+                path = diff.next()
+                if path not in paths:
+                    continue
+                mode, x, sha = info[1:].split(' ')[:3]
+                input.append("%s %s\t%s" % (mode, sha, path))
+        if not input:
+            return
+        rc = run_command(cmd, input='\0'.join(input) + '\0')
         if rc:
             raise YapError("Failed to unstage")
 
-    def _revert_one(self, file):
-        self._assert_file_exists(file)
+    def _unstage_files(self, files):
+        for f in files:
+            self._assert_file_exists(f)
+        self._unstage_paths(self._rel_paths_to_repo(files))
+
+    def _unstage_one(self, file):
+        self._unstage_files([file])
+
+    def _revert_scope(self, scope):
+        "Return everything in scope to its state in HEAD"
+        self._remove_new_files(self._get_new_files(scope))
+        if not (self._get_staged_files(scope)
+                or self._get_unstaged_files(scope)):
+            return
+        cmd = ['git', 'restore', '--source=HEAD', '--staged', '--worktree',
+                '--'] + pathspecs(scope)
+        if run_command(cmd):
+            raise YapError("Failed to revert")
+
+    def _revert_files(self, files):
+        files = list(files)
+        for f in files:
+            self._assert_file_exists(f)
         try:
-            self._unstage_one(file)
+            self._unstage_files(files)
         except YapError:
             pass
-        run_safely("git checkout-index -u -f '%s'" % file)
+        cmd = ['git', 'checkout-index', '-u', '-f', '-z', '--stdin']
+        run_safely(cmd, input='\0'.join(files) + '\0')
+
+    def _revert_one(self, file):
+        self._revert_files([file])
 
     def _parse_commit(self, commit):
-        lines = get_output("git cat-file commit '%s'" % commit)
+        data = self._objects().read("%s^{commit}" % commit)
+        if data is None:
+            raise YapError("Not a commit: %s" % commit)
+        lines = [ x.strip() for x in data[2].split('\n') ]
+        if lines and not lines[-1]:
+            lines.pop()
         commit = {}
 
         mode = None
@@ -258,21 +411,29 @@ class YapCore(object):
         commit['log'] = '\n'.join(commit['log'])
         return commit
 
-    def _check_commit(self, **flags):
+    def _check_commit(self, scope=None, **flags):
         if '-a' in flags and '-d' in flags:
             raise YapError("Conflicting flags: -a and -d")
 
-        if '-d' not in flags and self._get_unstaged_files():
-            if '-a' not in flags and self._get_staged_files():
+        if '-d' not in flags and self._get_unstaged_files(scope):
+            if '-a' not in flags and self._get_staged_files(scope):
                 raise YapError("Staged and unstaged changes present.  Specify what to commit")
-	    cdup = self._get_cdup()
-	    run_command("(cd %s; git add -u)" % cdup)
-            for f in self._get_new_files():
-                self._stage_one(f)
+	    run_command(['git', 'add', '-u', '--'] + pathspecs(scope))
+            self._stage_new_files(scope)
+
+    def _check_staged_outside(self, scope):
+        "Refuse to commit staged changes that a scoped status does not show"
+        if scope is None or self._objects().info("HEAD") is None:
+            return
+        cmd = ['git', 'diff-index', '--cached', '--quiet', 'HEAD', '--', ':/']
+        cmd += [ ':(top,literal,exclude)' + x for x in scope ]
+        if run_command(cmd):
+            raise YapError("Changes outside %s are staged too.  Unstage them or commit from the top"
+                    % ', '.join(self._repo_paths_to_rel(scope)))
 
     def _do_uncommit(self):
         commit = self._parse_commit("HEAD")
-        repo = get_output('git rev-parse --git-dir')[0]
+        repo = self._get_git_dir()
         dir = os.path.join(repo, 'yap')
         try:
             os.mkdir(dir)
@@ -283,18 +444,22 @@ class YapCore(object):
         print >>fd, commit['log']
         fd.close()
 
-        tree = get_output("git rev-parse --verify HEAD^")
-        run_safely("git update-ref -m uncommit HEAD '%s'" % tree[0])
+        parent = self._objects().info("HEAD^")
+        run_safely(['git', 'update-ref', '-m', 'uncommit', 'HEAD', parent[0]])
 
-    def _do_commit(self, msg=None):
-        tree = get_output("git write-tree")[0]
+    def _do_commit(self, msg=None, scope=None):
+        import pickle
+        import tempfile
+        tree = get_output(['git', 'write-tree'])[0]
 
-	repo = get_output('git rev-parse --git-dir')[0]
+	repo = self._get_git_dir()
 	head_file = os.path.join(repo, 'yap', 'merge')
 	try:
 	    parent = pickle.load(file(head_file))
 	except IOError:
-	    parent = get_output("git rev-parse --verify HEAD 2> /dev/null")
+	    parent = self._objects().info("HEAD")
+	    if parent is not None:
+		parent = [ parent[0] ]
 
         if os.environ.has_key('YAP_EDITOR'):
             editor = os.environ['YAP_EDITOR']
@@ -317,7 +482,9 @@ class YapCore(object):
 		    print >>fd2, l.strip()
 		fd2.close()
 		os.unlink(msg_file)
-	    if os.system("%s '%s'" % (editor, tmpfile)) != 0:
+	    # Like git, let the shell split up the editor command line
+	    cmd = ['sh', '-c', '%s "$@"' % editor, editor, tmpfile]
+	    if run_interactive(cmd) != 0:
 		raise YapError("Editing commit message failed")
 	    fd = file(tmpfile)
 	    msg = fd.readlines()
@@ -327,22 +494,85 @@ class YapCore(object):
 	if not msg:
 	    raise YapError("Refusing to use empty commit message")
 
-	fd = os.popen("git stripspace > %s" % tmpfile, 'w')
-	print >>fd, msg,
-	fd.close()
+	msg = get_output(['git', 'stripspace'], strip=False, input=msg)
+	msg = ''.join(msg)
 
+        cmd = ['git', 'commit-tree', tree]
         if parent:
-	    parent = ' -p '.join(parent)
-            commit = get_output("git commit-tree '%s' -p %s < '%s'" % (tree, parent, tmpfile))
-        else:
-            commit = get_output("git commit-tree '%s' < '%s'" % (tree, tmpfile))
+            for p in parent:
+                cmd += ['-p', p]
+        commit = get_output(cmd, input=msg)
 
         os.unlink(tmpfile)
-        run_safely("git update-ref HEAD '%s'" % commit[0])
-	self._clear_state()
+        run_safely(['git', 'update-ref', 'HEAD', commit[0]])
+	self._clear_state(scope)
+	self._update_commit_graph()
+
+    def _update_commit_graph(self):
+	"""Add new commits to git's commit-graph, with changed-path Bloom
+	filters, so that path-limited history walks can skip the commits
+	that did not touch the path.  Set yap.commitGraph to false to turn
+	this off."""
+	if not self._get_config_bool("yap.commitGraph", True):
+	    return
+	cmd = ['git', 'commit-graph', 'write', '--reachable', '--changed-paths']
+	chain = os.path.join(self._get_git_dir(), 'objects', 'info',
+			     'commit-graphs', 'commit-graph-chain')
+	if not os.path.exists(chain):
+	    # The first write filters all of history, which takes minutes on
+	    # a large repository, so it is left to run in the background.  A
+	    # graph written by gc has no filters and is replaced.
+	    self._start_first_commit_graph(cmd + ['--split=replace'])
+	    return
+	# Only the commits not yet in the graph get a new layer, and the
+	# filters computed for it are capped in case a fetch brought many
+	run_command(cmd + ['--split', '--max-new-filters=%d' % MAX_NEW_FILTERS])
+
+    def _start_first_commit_graph(self, cmd):
+	"""Start cmd in the background unless an earlier one still runs;
+	.git/yap/commit-graph.pending holds the pid of the one started"""
+	dir = os.path.join(self._get_git_dir(), 'yap')
+	pending = os.path.join(dir, 'commit-graph.pending')
+	try:
+	    os.makedirs(dir)
+	except OSError:
+	    pass
+	for attempt in 0, 1:
+	    try:
+		fd = os.open(pending, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+		break
+	    except OSError, e:
+		if e.errno != errno.EEXIST or not self._is_stale_pending(pending):
+		    return
+		try:
+		    os.unlink(pending)
+		except OSError:
+		    pass
+	else:
+	    return
+	try:
+	    os.write(fd, "%d\n" % run_background(cmd))
+	finally:
+	    os.close(fd)
+
+    def _is_stale_pending(self, pending):
+	"True if the write a pending file names has finished or failed"
+	try:
+	    data = file(pending).read().strip()
+	    age = time.time() - os.stat(pending).st_mtime
+	except (IOError, OSError):
+	    return True
+	if not data:
+	    # Still being written, unless its writer died
+	    return age > 60
+	try:
+	    os.kill(int(data), 0)
+	except (ValueError, OSError):
+	    return True
+	return False
 
     def _check_rebasing(self):
-        repo = get_output('git rev-parse --git-dir')[0]
+        repo = self._get_git_dir()
         dotest = os.path.join(repo, '.dotest')
         if os.access(dotest, os.R_OK):
             raise YapError("A git operation is in progress.  Complete it first")
@@ -351,33 +581,65 @@ class YapCore(object):
             raise YapError("A git operation is in progress.  Complete it first")
 
     def _check_git(self):
-	if run_command("git rev-parse --git-dir"):
+	if self._get_git_dir() is None:
 	    raise YapError("That command must be run from inside a git repository")
 
     def _list_remotes(self):
-        remotes = get_output("git config --get-regexp '^remote.*.url'")
-        for x in remotes:
-            remote, url = x.split(' ')
+        remotes = self._get_context().config_regexp(r'^remote\..*\.url$')
+        for remote, url in remotes:
             remote = remote.replace('remote.', '')
             remote = remote.replace('.url', '')
             yield remote, url
 
     def _unstage_all(self):
 	try:
-	    run_safely("git read-tree -m HEAD")
+	    run_safely(['git', 'read-tree', '-m', 'HEAD'])
 	except ShellError:
-	    run_safely("git read-tree HEAD")
-	    run_safely("git update-index -q --refresh")
+	    run_safely(['git', 'read-tree', 'HEAD'])
+	    self._refresh_index(quiet=True)
+
+    def _refresh_index(self, quiet=False):
+        """Refresh the stat data in the index, as update-index --refresh
+        does.  Unless quiet, return True if files still differ from it.
+        With yap.refreshThreads above 1, the work tree is stated on that
+        many threads first, which helps on network filesystems."""
+        threads = self._get_config("yap.refreshThreads", "1")
+        try:
+            threads = int(threads)
+        except ValueError:
+            raise YapError("yap.refreshThreads is not a number: %s" % threads)
+
+        # A filesystem monitor already spares git from stating everything
+        if threads > 1 and not self._get_config("core.fsmonitor"):
+            import refresh
+            from status import index_path
+            hash_size = 20
+            if self._get_config("extensions.objectformat") == "sha256":
+                hash_size = 32
+            try:
+                changed = refresh.refresh_index(self._get_cdup(),
+                        index_path(), threads, hash_size)
+            except refresh.UnsupportedIndex:
+                pass
+            else:
+                if quiet:
+                    return None
+                return bool(changed)
+
+        if quiet:
+            run_safely(['git', 'update-index', '-q', '--refresh'])
+            return None
+        return run_command(['git', 'update-index', '--refresh']) != 0
 
     def _get_tracking(self, current):
-	remote = get_output("git config branch.%s.remote" % current)
+	remote = self._get_config("branch.%s.remote" % current)
         if not remote:
             raise YapError("No tracking branch configured for '%s'" % current)
 
-        merge = get_output("git config branch.%s.merge" % current)
+        merge = self._get_config("branch.%s.merge" % current)
         if not merge:
             raise YapError("No tracking branch configured for '%s'" % current)
-        return remote[0], merge[0]
+        return remote, merge
 
     def _confirm_push(self, current, rhs, repo):
         print "About to push local branch '%s' to '%s' on '%s'" % (current, rhs, repo)
@@ -388,57 +650,147 @@ class YapCore(object):
         if ans.lower() != 'y' and ans.lower() != 'yes':
             raise YapError("Aborted.")
 
-    def _clear_state(self):
-	repo = get_output('git rev-parse --git-dir')[0]
+    def _clear_state(self, scope=None):
+	"""Forget the new files, merge and saved message.  With a scope,
+	only the new files in it are forgotten."""
+	repo = self._get_git_dir()
         dir = os.path.join(repo, 'yap')
-	for f in "new-files", "merge", "msg":
+	state = ["merge", "msg"]
+	if scope is None:
+	    state.append("new-files")
+	else:
+	    self._remove_new_files(self._get_new_files(scope))
+	for f in state:
 	    try:
 		os.unlink(os.path.join(dir, f))
 	    except OSError:
 		pass
 
-    def _get_attr(self, name, attr):
-	val = None
-	for c in self.__class__.__bases__:
-	    try:
-		m2 = c.__dict__[name]
-	    except KeyError:
-		continue
-	    try:
-		val = m2.__getattribute__(attr)
-	    except AttributeError:
-		continue
-	return val
-
-    def _filter_log(self, commit):
-        return commit
+    def _command_table(self):
+	"""Return a dict mapping each cmd_* method to a dict of its usage
+	string, help and the options every class accepts for it.  The
+	table is built once for each combination of plugins."""
+	cls = self.__class__
+	table = _command_tables.get(cls)
+	if table is not None:
+	    return table
+
+	table = dict()
+	for c in cls.__mro__:
+	    for name, m in c.__dict__.items():
+		if not name.startswith('cmd_') or not callable(m):
+		    continue
+		entry = table.setdefault(name, dict(options=""))
+		entry['options'] += getattr(m, 'options', "")
+		# The class furthest from Yap wins, as with __doc__ below
+		for attr in '__doc__', 'short_help', 'long_help':
+		    try:
+			entry[attr] = m.__getattribute__(attr)
+		    except AttributeError:
+			pass
+	_command_tables[cls] = table
+	return table
 
-    def _check_rename(self, rev, path):
-        renames = get_output("git diff-tree -C -M -r --diff-filter=R %s %s^"
-                % (rev, rev))
-        for r in renames:
-            r = r.replace('\t', ' ')
-            fields = r.split(' ')
-            mode1, mode2, hash1, hash2, rename, dst, src = fields
-            if dst == path:
-                return src
-        return None
-
-    def _expand_directories(self, files):
-	files = list(files)
-	for i, f in enumerate(files[:]):
-	    if not os.path.isdir(f):
-		continue
+    def _get_attr(self, name, attr):
+	entry = self._command_table().get(name)
+	if entry is None:
+	    return None
+	return entry.get(attr)
+
+    def _filter_log(self, lines):
+        """Filter the log as it is shown.  lines yields (part, line) pairs,
+        where part says which part of a commit the line is in: 'commit'
+        for its first line, then 'header', 'message', 'diff' and 'end' for
+        the blank line after it.  Plugins chain onto this and yield pairs
+        in the same form; a commit's diff may be far too large to hold."""
+        return lines
+
+    def _log_lines(self, args, rev, paths, follow, color, count=None):
+        """Yield the log's (part, line) pairs, following the file follow,
+        if it is not None, back through its renames.  If count is not
+        None, git stops walking history after that many commits."""
+        import log
+        cwd = None
+        if follow is not None:
+            import renames
+            index = renames.RenameIndex(self._get_git_dir())
+            index.update(rev)
+            # git only consults the commit-graph's changed-path filters for
+            # a single pathspec with no magic but 'literal'
+            cwd = self._get_cdup()
+            paths = [':(literal)' + follow]
+        while True:
+            limit = []
+            if count is not None:
+                if count <= 0:
+                    return
+                limit = ['--max-count=%d' % count]
+            # Once the commit that gave the file its name is known, the walk
+            # need not go on past it
+            revs = [rev]
+            if follow is not None:
+                stops = [ x for x in index.renamed_to(follow)
+                          if self._ancestry().is_ancestor(x, rev) ]
+                if len(stops) == 1:
+                    revs.append('^%s^' % stops[0])
+            cmd = log.log_command(args + limit + revs + ['--'] + paths, color)
+            source = None
+            for part, line in log.read_log(cmd, color, cwd):
+                yield part, line
+                if part == 'end':
+                    if count is not None:
+                        count -= 1
+                    if source is not None:
+                        break
+                elif part == 'commit' and follow is not None:
+                    hash = log.commit_hash(line)
+                    source = index.source(hash, follow)
+
+            # Carry on from before the rename under the file's old name
+            if source is None:
+                return
+            follow = source
+            paths = [':(literal)' + follow]
+            rev = hash + '^'
+
+    def _get_ignore_rules(self):
+        import ignore
+        excludes = self._get_config("core.excludesFile")
+        if excludes is None:
+            config = os.getenv('XDG_CONFIG_HOME') \
+                    or os.path.join(os.path.expanduser('~'), '.config')
+            excludes = os.path.join(config, 'git', 'ignore')
+        return ignore.IgnoreRules(self._get_cdup(), self._get_git_dir(),
+                excludes)
+
+    def _expand_directories(self, files, tracked=False):
+        """Replace each directory in files by the files below it that git
+        does not ignore.  If tracked is set, files in the index are kept
+        even where they are ignored."""
+        import ignore
+        result = []
+        rules = None
+        for f in files:
+            if not os.path.isdir(f) or os.path.islink(f):
+                result.append(f)
+                continue
+            if rules is None:
+                rules = self._get_ignore_rules()
+            dir = self._rel_paths_to_repo([f])[0]
+            found = list(ignore.walk(f, dir, rules))
+            result += found
+            if not tracked:
+                continue
 
-	    del files[i]
-	    fd = os.popen("find %s -type f" % f)
-	    for x in fd.xreadlines():
-		x = x.strip()
-		if '.git' in x.split(os.path.sep):
-		    continue
-		files.append(x)
-	return files
-        
+            seen = set(self._rel_paths_to_repo(found))
+            if dir == '.':
+                under = tracked_files()
+            else:
+                under = tracked_files().under(dir)
+            under = [ x for x in under if x not in seen ]
+            result += [ x for x in self._repo_paths_to_rel(under)
+                        if os.path.lexists(x) ]
+        return result
 
     @short_help("make a local copy of an existing repository")
     @long_help("""
@@ -446,10 +798,12 @@ The first argument is a URL to the existing repository.  This can be an
 absolute path if the repository is local, or a URL with the git://,
 ssh://, or http:// schemes.  By default, the directory used is the last
 component of the URL, sans '.git'.  This can be overridden by providing
-a second argument.
+a second argument.  With '-s', only the given comma-separated
+directories are checked out; see 'sparse'.
 """)
-    def cmd_clone(self, url, directory=None):
-        "<url> [directory]"
+    @takes_options("s:")
+    def cmd_clone(self, url, directory=None, **flags):
+        "[-s <dir>,...] <url> [directory]"
 
 	if '://' not in url:
 	    if url[0] != '/':
@@ -471,24 +825,30 @@ a second argument.
         self.cmd_fetch("origin")
 
         branch = None
-        if not run_command("git rev-parse --verify refs/remotes/origin/HEAD"):
-            hash = get_output("git rev-parse refs/remotes/origin/HEAD")[0]
-            for b in get_output("git for-each-ref --format='%(refname)' 'refs/remotes/origin'"):
-                if get_output("git rev-parse %s" % b)[0] == hash:
+        if self._objects().info("refs/remotes/origin/HEAD") is not None:
+            hash = self._objects().info("refs/remotes/origin/HEAD")[0]
+            for b in get_output(['git', 'for-each-ref',
+                        '--format=%(objectname) %(refname)',
+                        'refs/remotes/origin']):
+                h, b = b.split(' ', 1)
+                if h == hash and b != "refs/remotes/origin/HEAD":
                     branch = b
                     break
         if branch is None:
-            if not run_command("git rev-parse --verify refs/remotes/origin/master"):
+            if self._objects().info("refs/remotes/origin/master") is not None:
                 branch = "refs/remotes/origin/master"
         if branch is None:
-            branch = get_output("git for-each-ref --format='%(refname)' 'refs/remotes/origin'")
+            branch = get_output(['git', 'for-each-ref', '--format=%(refname)',
+                                'refs/remotes/origin'])
             branch = branch[0]
 
-        hash = get_output("git rev-parse %s" % branch)
+        hash = self._objects().info(branch)
         assert hash
         branch = branch.replace('refs/remotes/origin/', '')
-        run_safely("git update-ref refs/heads/%s %s" % (branch, hash[0]))
-        run_safely("git symbolic-ref HEAD refs/heads/%s" % branch)
+        run_safely(['git', 'update-ref', 'refs/heads/%s' % branch, hash[0]])
+        self._set_head("refs/heads/%s" % branch)
+        if '-s' in flags:
+            self._set_sparse('set', [ x for x in flags['-s'].split(',') if x ])
         self.cmd_revert(**{'-a': 1})
 
     @short_help("turn a directory into a repository")
@@ -498,7 +858,8 @@ side-effect of this command is the creation of a '.git' subdirectory.
 No files are added nor commits made.
 """)
     def cmd_init(self):
-        os.system("git init")
+        run_interactive(['git', 'init'])
+        self._get_context().invalidate()
 	os.mkdir(os.path.join(".git", "yap"))
 
     @short_help("add a new file to the repository")
@@ -515,8 +876,7 @@ reverse the effects of this command, see 'rm'.
             raise TypeError
         
 	files = self._expand_directories(files)
-        for f in files:
-            self._add_one(f)
+        self._add_files(files)
         self.cmd_status()
 
     @short_help("delete a file from the repository")
@@ -532,8 +892,7 @@ just no longer tracked as part of the repository.
         if not files:
             raise TypeError
         
-        for f in files:
-            self._rm_one(f)
+        self._rm_files(self._expand_directories(files, tracked=True))
         self.cmd_status()
 
     @short_help("stage changes in a file for commit")
@@ -550,9 +909,8 @@ files will show as "staged changes" in the output of 'status'.
         if not files:
             raise TypeError
         
-	files = self._expand_directories(files)
-        for f in files:
-            self._stage_one(f)
+	files = self._expand_directories(files, tracked=True)
+        self._stage_files(files)
         self.cmd_status()
 
     @short_help("unstage changes in a file")
@@ -567,13 +925,16 @@ flag can be used to unstage all staged changes at once.
         self._check_git()
         if '-a' in flags:
 	    files = self._get_staged_files()
-	    files = [ self._repo_path_to_rel(x) for x in files ]
+	    if not files:
+		raise YapError("Nothing to do")
+	    self._unstage_paths(files)
+	    self.cmd_status()
+	    return
 
         if not files:
             raise YapError("Nothing to do")
         
-        for f in files:
-            self._unstage_one(f)
+        self._unstage_files(self._expand_directories(files, tracked=True))
         self.cmd_status()
 
     @short_help("show files with staged and unstaged changes")
@@ -582,36 +943,35 @@ Show the files in the repository with changes since the last commit,
 categorized based on whether the changes are staged or not.  A file may
 appear under each heading if the same file has both staged and unstaged
 changes.
+
+If paths are given, only files at or below them are considered.  If
+yap.scopeToCwd is true, the default is the current directory instead of
+the whole repository.  The same setting limits 'diff', 'commit' and
+'revert -a'.
 """)
-    def cmd_status(self):
-	""
+    def cmd_status(self, *paths):
+	"[<path>...]"
         self._check_git()
-        branch = get_output("git symbolic-ref HEAD")
+        scope = self._get_scope(paths)
+        branch = self._get_head()
 	if branch:
-	    branch = branch[0].replace('refs/heads/', '')
+	    branch = branch.replace('refs/heads/', '')
 	else:
 	    branch = "DETACHED"
         print "Current branch: %s" % branch
+	if scope is not None:
+	    print "Limited to: %s" % ' '.join(self._repo_paths_to_rel(scope))
 
         print "Files with staged changes:"
-        files = self._get_staged_files()
-        for f in files:
-            print "\t%s" % self._repo_path_to_rel(f)
-        if not files:
-            print "\t(none)"
+        self._print_files(self._get_staged_files(scope))
 
         print "Files with unstaged changes:"
-        files = self._get_unstaged_files()
-        for f in files:
-            print "\t%s" % self._repo_path_to_rel(f)
-        if not files:
-            print "\t(none)"
+        self._print_files(self._get_unstaged_files(scope))
 	
-	files = self._get_unmerged_files()
+	files = self._get_unmerged_files(scope)
 	if files:
 	    print "Files with conflicts:"
-	    for f in files:
-		print "\t%s" % self._repo_path_to_rel(f)
+	    self._print_files(files)
 
     @short_help("remove uncommitted changes from a file (*)")
     @long_help("""
@@ -625,9 +985,15 @@ editing each file again.
         "(-a | <file>)"
         self._check_git()
         if '-a' in flags:
+	    scope = self._get_scope()
+	    if scope is not None:
+		self._revert_scope(scope)
+		self.cmd_status()
+		return
 	    cdup = self._get_cdup()
-	    run_command("(cd %s; git add -u)" % cdup)
-	    os.system("git read-tree -v --aggressive -u -m HEAD")
+	    run_command(['git', 'add', '-u'], cwd=cdup)
+	    run_interactive(['git', 'read-tree', '-v', '--aggressive', '-u',
+				'-m', 'HEAD'])
 	    self._clear_state()
 	    self.cmd_status()
             return
@@ -635,8 +1001,7 @@ editing each file again.
         if not files:
             raise TypeError
 
-        for f in files:
-            self._revert_one(f)
+        self._revert_files(files)
         self.cmd_status()
 
     @short_help("record changes to files as a new commit")
@@ -653,11 +1018,13 @@ command, see 'uncommit'.
 	"[-a | -d] [-m <msg>]"
         self._check_git()
         self._check_rebasing()
-        self._check_commit(**flags)
-        if not self._get_staged_files():
+        scope = self._get_scope()
+        self._check_staged_outside(scope)
+        self._check_commit(scope, **flags)
+        if not self._get_staged_files(scope):
             raise YapError("No changes to commit")
         msg = flags.get('-m', None)
-        self._do_commit(msg)
+        self._do_commit(msg, scope)
         self.cmd_status()
 
     @short_help("reverse the actions of the last commit")
@@ -674,10 +1041,195 @@ operation.
         self._do_uncommit()
         self.cmd_status()
 
+    def _set_sparse(self, subcmd, dirs):
+        "Run git sparse-checkout set or add with repository-relative dirs"
+        dirs = self._rel_paths_to_repo(dirs)
+        for d in dirs:
+            if d.startswith('..'):
+                raise YapError("Not in the repository: %s" % d)
+        cmd = ['git', 'sparse-checkout', subcmd]
+        if subcmd == 'set':
+            cmd.append('--cone')
+        if run_command(cmd + ['--'] + dirs, cwd=self._get_cdup()):
+            raise YapError("Failed to update the sparse checkout")
+        self._get_context().invalidate()
+
+    @short_help("limit the working tree to some directories")
+    @long_help("""
+With 'set', only the given directories, and the files directly inside
+the directories above them, are checked out; everything else is removed
+from the working tree and left out of 'status', 'switch', 'point',
+'revert' and new workdirs.  'add' extends the set of directories and
+'disable' checks out the whole tree again.  Without a subcommand, or
+with 'list', the directories in use are printed.  A repository can be
+cloned sparsely with 'clone -s'.
+""")
+    def cmd_sparse(self, subcmd="list", *dirs):
+        "[list | set <dir>... | add <dir>... | disable]"
+        self._check_git()
+        if subcmd == "list":
+            if dirs:
+                raise TypeError
+            if not self._get_config_bool("core.sparseCheckout"):
+                print "The whole tree is checked out"
+                return
+            for d in get_output(['git', 'sparse-checkout', 'list']):
+                print d
+            return
+
+        if subcmd in ("set", "add"):
+            if not dirs:
+                raise TypeError
+            self._set_sparse(subcmd, dirs)
+        elif subcmd == "disable":
+            if dirs:
+                raise TypeError
+            if run_command(['git', 'sparse-checkout', 'disable']):
+                raise YapError("Failed to disable the sparse checkout")
+            self._get_context().invalidate()
+        else:
+            raise TypeError
+        self.cmd_status()
+
+    @short_help("run a background server to answer status queries quickly")
+    @long_help("""
+The 'start' subcommand starts a server for the current repository that
+keeps yap loaded between commands.  While it runs, 'status', and
+'branch', 'repo', 'track' and 'version' without arguments, are answered
+by the server, which matters for shell prompts and editors that ask
+often.  The server exits after yap.daemonTimeout seconds (default 600)
+without a request, or when stopped with 'stop'.  'status' reports
+whether a server is running.
+
+If yap.watch is true, the server also watches the work tree with
+inotify and sets core.fsmonitor so that git, and yap through it, only
+looks at files that have changed.  core.fsmonitor is removed again when
+the server exits.
+""")
+    def cmd_daemon(self, subcmd):
+	"start | stop | status"
+	import daemon
+	self._check_git()
+	if subcmd not in ("start", "stop", "status"):
+	    raise TypeError
+
+	gitdir = os.path.abspath(self._get_git_dir())
+	pid = daemon.running_pid(gitdir)
+	if subcmd == "status":
+	    if pid is None:
+		print "No yap daemon is running"
+	    else:
+		print "yap daemon running as pid %d" % pid
+	elif subcmd == "stop":
+	    if not daemon.stop(gitdir):
+		raise YapError("No yap daemon is running")
+	else:
+	    # Workdirs share .git/yap, and with it the daemon's socket
+	    if os.path.islink(os.path.join(gitdir, 'yap')):
+		raise YapError("Start the daemon in the repository this workdir was made from")
+	    if pid is not None:
+		raise YapError("A yap daemon is already running as pid %d" % pid)
+	    timeout = self._get_config("yap.daemonTimeout", "600")
+	    try:
+		timeout = float(timeout)
+	    except ValueError:
+		raise YapError("yap.daemonTimeout is not a number: %s" % timeout)
+
+	    watcher = None
+	    hook = None
+	    if self._get_config_bool("yap.watch"):
+		import watch
+		hook = daemon.hook_command(sys.argv[0])
+		current = self._get_config("core.fsmonitor")
+		if current not in (None, hook):
+		    raise YapError("core.fsmonitor is already set to %s" % current)
+		try:
+		    watcher = watch.Watcher(self._get_cdup() or '.')
+		except watch.WatchError, e:
+		    raise YapError(str(e))
+		self._set_config("core.fsmonitor", hook)
+	    daemon.start(self, gitdir, timeout, watcher, hook)
+
     @short_help("report the current version of yap")
     def cmd_version(self):
         print "Yap version %s" % self.version
 
+    def _print_profile(self, events, elapsed):
+	def tally(key):
+	    totals = dict()
+	    for e in events:
+		k = key(e)
+		count, wall = totals.get(k, (0, 0.0))
+		totals[k] = (count + 1, wall + e['wall'])
+	    totals = [ (v[1], v[0], k) for k, v in totals.items() ]
+	    totals.sort()
+	    totals.reverse()
+	    return totals[:10]
+
+	def command(e):
+	    argv = e['argv']
+	    if isinstance(argv, basestring):
+		argv = argv.split()
+	    return ' '.join(argv[:2])
+
+	# Work yap did itself rather than in a process, such as the
+	# parallel stat refresh
+	stages = [ e for e in events if e['argv'][:1] == ['yap'] ]
+	events = [ e for e in events if e['argv'][:1] != ['yap'] ]
+
+	spent = 0.0
+	for e in events:
+	    spent += e['wall']
+	print >>sys.stderr
+	print >>sys.stderr, "%d processes ran for %.3fs in all; the command took %.3fs" % (
+		len(events), spent, elapsed)
+	print >>sys.stderr
+	print >>sys.stderr, "%6s %9s  %s" % ("calls", "time", "call site")
+	for wall, count, site in tally(lambda e: "%s (%s)" % (e['method'],
+						e['site'])):
+	    print >>sys.stderr, "%6d %8.3fs  %s" % (count, wall, site)
+	print >>sys.stderr
+	print >>sys.stderr, "%6s %9s  %s" % ("calls", "time", "command")
+	for wall, count, cmd in tally(command):
+	    print >>sys.stderr, "%6d %8.3fs  %s" % (count, wall, cmd)
+	if stages:
+	    print >>sys.stderr
+	for e in stages:
+	    if 'saved' in e:
+		print >>sys.stderr, ("stat refresh of %d entries on %d threads "
+			"took %.3fs and saved about %.3fs" % (e['entries'],
+			    e['threads'], e['wall'], e['saved']))
+	    elif 'renames' in e:
+		print >>sys.stderr, ("rename index update took %.3fs and found "
+			"%d renames" % (e['wall'], e['renames']))
+	    elif e.get('first') is not None:
+		print >>sys.stderr, ("log showed its first commit after %.3fs "
+			"and %d commits in %.3fs" % (e['first'], e['commits'],
+			    e['wall']))
+
+    @short_help("run a command and report where its time went")
+    @long_help("""
+The arguments are a yap command and its arguments.  The command is run
+as usual, after which a summary of the git and svn processes it started
+is printed: how many there were, how long they took, and which yap
+methods started them.  Setting YAP_TRACE to a file name records each
+process of any yap command to that file instead; "-" means stderr.
+""")
+    def cmd_profile(self, *args):
+	"<command> [<args>...]"
+	if not args:
+	    raise TypeError
+
+	start_trace()
+	start = time.time()
+	try:
+	    try:
+		self.main(list(args))
+	    except SystemExit:
+		pass
+	finally:
+	    self._print_profile(trace_events(), time.time() - start)
+
     @short_help("show the changelog for particular versions or files")
     @long_help("""
 The arguments are the files with which to filter history.  If none are
@@ -685,75 +1237,106 @@ given, all changes are listed.  Otherwise only commits that affected one
 or more of the given files are listed.  The -r option changes the
 starting revision for traversing history.  By default, history is listed
 starting at HEAD.
+
+The -n option shows at most that many commits.  The -s and -u options
+show only commits made since or until a date, such as "2 weeks ago" or
+"2009-06-01", and -a only those whose author matches a pattern.  History
+is only walked as far as these limits need, so they are much faster than
+cutting the output short.
+
+To make listing the history of a file fast, yap adds new commits to git's
+commit-graph, with changed-path filters, after commit, fetch and update.
+The first time, the whole graph is written in the background.  Set
+yap.commitGraph to false to stop it.
 """)
-    @takes_options("pr:")
+    @takes_options("pr:n:s:u:a:")
     def cmd_log(self, *paths, **flags):
-        "[-p] [-r <rev>] <path>..."
+        "[-p] [-r <rev>] [-n <count>] [-s <date>] [-u <date>] [-a <author>] <path>..."
         self._check_git()
         rev = flags.get('-r', 'HEAD')
         rev = self._resolve_rev(rev)
         paths = list(paths)
 
-	if '-p' in flags:
-	    flags['-p'] = '-p'
+        limit = None
+        if '-n' in flags:
+            try:
+                limit = int(flags['-n'])
+            except ValueError:
+                raise YapError("Not a number: %s" % flags['-n'])
 
-	if stdout_is_tty():
-	    color = "--color"
+	from util import _record
+	color = stdout_is_tty()
+	args = ['-M', '-C']
+	if '-p' in flags:
+	    args.append('-p')
 	else:
-	    color = ""
-
-        try:
-            pager = os.popen(self._get_pager_cmd(), 'w')
-            rename = False
-            while True:
-                cmd = ['git', 'rev-list', rev, '--' ] + paths
-		for hash in yield_output(cmd):
-                    commit = get_output("git show %s --date=local -M -C %s %s"
-                            % (color, flags.get('-p', '--name-status'), hash),
-                            strip=False)
-                    commit = self._filter_log(commit)
-                    print >>pager, ''.join(commit)
-
-                    # Check for renames
-                    if len(paths) == 1:
-                        src = self._check_rename(hash, paths[0])
-                        if src is not None:
-                            paths[0] = src
-                            rename = True
-                            rev = hash+"^"
-                            break
-                if not rename:
-                    break
-                rename = False
-        except (IOError, KeyboardInterrupt):
-            pass
+	    args.append('--name-status')
+	if paths:
+	    # Show whole commits, not just the named files
+	    args.append('--full-diff')
+	if '-s' in flags:
+	    args.append('--since=%s' % flags['-s'])
+	if '-u' in flags:
+	    args.append('--until=%s' % flags['-u'])
+	if '-a' in flags:
+	    args.append('--author=%s' % flags['-a'])
+
+	follow = None
+	if len(paths) == 1 and not os.path.isdir(paths[0]):
+	    follow = self._rel_paths_to_repo(paths)[0]
+
+	start = time.time()
+	first = None
+	count = 0
+	lines = self._filter_log(self._log_lines(args, rev, paths, follow,
+						 color, limit))
+	try:
+	    pager = os.popen(self._get_pager_cmd(), 'w')
+	    for part, line in lines:
+		pager.write(line)
+		if part == 'end':
+		    count += 1
+		    if first is None:
+			pager.flush()
+			first = time.time() - start
+	except (IOError, KeyboardInterrupt):
+	    pass
+	_record(['yap', 'log'], start, 0, 0, commits=count, first=first)
 
     @short_help("show staged, unstaged, or all uncommitted changes")
     @long_help("""
 Show staged, unstaged, or all uncommitted changes.  By default, all
 changes are shown.  The '-u' flag causes only unstaged changes to be
-shown.  The '-d' flag causes only staged changes to be shown.
+shown.  The '-d' flag causes only staged changes to be shown.  If paths
+are given, only changes at or below them are shown.
 """)
     @takes_options("ud")
-    def cmd_diff(self, **flags):
-        "[ -u | -d ]"
+    def cmd_diff(self, *paths, **flags):
+        "[ -u | -d ] [<path>...]"
         self._check_git()
         if '-u' in flags and '-d' in flags:
             raise YapError("Conflicting flags: -u and -d")
+        scope = self._get_scope(paths)
+        if scope is None:
+            limit = []
+        else:
+            limit = ['--'] + pathspecs(scope)
 
         pager = self._get_pager_cmd()
 
 	if stdout_is_tty():
-	    color = "--color"
+	    color = ['--color']
 	else:
-	    color = ""
+	    color = []
 
         if '-u' in flags:
-            os.system("git diff-files %s -p | %s" % (color, pager))
+            run_paged(['git', 'diff-files'] + color + ['-p'] + limit, pager)
         elif '-d' in flags:
-            os.system("git diff-index %s --cached -p HEAD | %s" % (color, pager))
+            run_paged(['git', 'diff-index'] + color + ['--cached', '-p', 'HEAD']
+                    + limit, pager)
         else:
-            os.system("git diff-index %s -p HEAD | %s" % (color, pager))
+            run_paged(['git', 'diff-index'] + color + ['-p', 'HEAD'] + limit,
+                    pager)
 
     @short_help("list, create, or delete branches")
     @long_help("""
@@ -782,15 +1365,16 @@ in spite of this.
             return
 
         if branch is not None:
-            ref = get_output("git rev-parse --verify HEAD")
+            ref = self._objects().info("HEAD")
             if not ref:
                 raise YapError("No branch point yet.  Make a commit")
-            run_safely("git update-ref 'refs/heads/%s' '%s'" % (branch, ref[0]))
+            run_safely(['git', 'update-ref', 'refs/heads/%s' % branch, ref[0]])
 
-        current = get_output("git symbolic-ref HEAD")
-        branches = get_output("git for-each-ref --format='%(refname)' 'refs/heads'")
+        current = self._get_head()
+        branches = get_output(['git', 'for-each-ref', '--format=%(refname)',
+                                'refs/heads'])
         for b in branches:
-            if current and b == current[0]:
+            if current and b == current:
                 print "* ",
             else:
                 print "  ",
@@ -805,6 +1389,10 @@ files.  Otherwise, the contents of the files in the working directory
 are updated to reflect their state in the new branch.  Additionally, any
 future commits are added to the new branch instead of the previous line
 of history.
+
+On network filesystems, setting yap.refreshThreads to a number above 1
+makes this and other commands that check the work tree against the
+index stat files on that many threads at once.
 """)
     @takes_options("f")
     def cmd_switch(self, branch, **flags):
@@ -816,7 +1404,7 @@ of history.
 	if '-f' not in flags:
 	    if (self._get_staged_files() 
 		    or (self._get_unstaged_files() 
-			and run_command("git update-index --refresh"))):
+			and self._refresh_index())):
 		raise YapError("You have uncommitted changes.  Use -f to continue anyway")
 
 	if self._get_unstaged_files() and self._get_staged_files():
@@ -825,22 +1413,21 @@ of history.
 	staged = bool(self._get_staged_files())
 
 	cdup = self._get_cdup()
-	run_command("(cd %s; git add -u)" % cdup)
-	for f in self._get_new_files():
-	    self._stage_one(f)
+	run_command(['git', 'add', '-u'], cwd=cdup)
+	self._stage_new_files()
 
-        tree = get_output("git rev-parse HEAD^{tree}")
-	idx = get_output("git write-tree")
+        tree = self._objects().info("HEAD^{tree}")
+	idx = get_output(['git', 'write-tree'])
         new = self._resolve_rev('refs/heads/'+branch)
 
-	run_command("git update-index --refresh")
+	self._refresh_index()
+        readtree = ['git', 'read-tree', '-v', '--aggressive', '-u', '-m']
         if tree[0] != idx[0]:
-            readtree = "git read-tree -v --aggressive -u -m HEAD %s %s" % (idx[0], new)
-        else:
-            readtree = "git read-tree -v --aggressive -u -m %s %s" % (idx[0], new)
-	if os.system(readtree):
+            readtree.append('HEAD')
+        readtree += [idx[0], new]
+	if run_interactive(readtree):
 	    raise YapError("Failed to switch")
-        run_safely("git symbolic-ref HEAD refs/heads/%s" % branch)
+        self._set_head("refs/heads/%s" % branch)
 
 	if '-f' not in flags:
 	    self._clear_state()
@@ -863,28 +1450,33 @@ operation in spite of this.
         self._check_git()
         self._check_rebasing()
 
-        head = get_output("git rev-parse --verify HEAD")
+        head = self._objects().info("HEAD")
         if not head:
             raise YapError("No commit yet; nowhere to point")
 
         ref = self._resolve_rev(where)
-        ref = get_output("git rev-parse --verify '%s^{commit}'" % ref)
-        if not ref:
+        ref = self._objects().info("%s^{commit}" % ref)
+        if ref is None:
             raise YapError("Not a commit: %s" % where)
 
         if self._get_unstaged_files() or self._get_staged_files():
             raise YapError("You have uncommitted changes.  Commit them first")
 
-        run_safely("git update-ref HEAD '%s'" % ref[0])
-
         if '-f' not in flags:
-            name = get_output("git name-rev --name-only '%s'" % head[0])[0]
-            if name == "undefined":
-                os.system("git update-ref HEAD '%s'" % head[0])
+            # The commits would be lost if no other ref, nor where the
+            # branch is going, still leads to them
+            exclude = ['HEAD']
+            if self._get_head():
+                exclude.append(self._get_head())
+            if not self._ancestry().reachable(head[0], exclude=exclude,
+                                              extra=[ref[0]]):
                 raise YapError("Pointing there will lose commits.  Use -f to force")
 
-	run_command("git update-index --refresh")
-	rc = os.system("git read-tree -v --reset -u HEAD")
+        run_safely(['git', 'update-ref', 'HEAD', ref[0]])
+        self._ancestry().forget_refs()
+
+	self._refresh_index()
+	rc = run_interactive(['git', 'read-tree', '-v', '--reset', '-u', 'HEAD'])
 	if rc:
 	    raise YapError("checkout-index failed")
 	self._clear_state()
@@ -910,21 +1502,24 @@ the same commit as when the rewrite started.
 """)
     def cmd_history(self, subcmd, *args):
         "amend | drop <commit>"
+        import tempfile
         self._check_git()
 
         if subcmd not in ("amend", "drop", "continue", "skip"):
             raise TypeError
 
-        resolvemsg = """
+        resolvemsg = """--resolvemsg=
 When you have resolved the conflicts run \"yap history continue\".
 To skip the problematic patch, run \"yap history skip\"."""
 
         if subcmd == "continue":
-            os.system("git am -3 -r --resolvemsg='%s'" % resolvemsg)
+            if run_interactive(['git', 'am', '-3', '-r', resolvemsg]) == 0:
+                self._update_commit_graph()
             return
         if subcmd == "skip":
-            os.system("git reset --hard")
-            os.system("git am -3 --skip --resolvemsg='%s'" % resolvemsg)
+            run_interactive(['git', 'reset', '--hard'])
+            if run_interactive(['git', 'am', '-3', '--skip', resolvemsg]) == 0:
+                self._update_commit_graph()
             return
 
         if subcmd == "amend":
@@ -949,24 +1544,28 @@ To skip the problematic patch, run \"yap history skip\"."""
 
         self._unstage_all()
 
-        start = get_output("git rev-parse HEAD")
-	stash = get_output("git stash create")
-        run_command("git reset --hard")
+        start = self._objects().info("HEAD")
+	stash = get_output(['git', 'stash', 'create'])
+        run_command(['git', 'reset', '--hard'])
         try:
 	    fd, tmpfile = tempfile.mkstemp("yap")
 	    try:
 		try:
-		    os.close(fd)
-		    os.system("git format-patch -k --stdout '%s' > %s" % (commit, tmpfile))
+		    patch = os.fdopen(fd, 'w')
+		    try:
+			run_command(['git', 'format-patch', '-k', '--stdout',
+					commit], stdout=patch)
+		    finally:
+			patch.close()
 		    if subcmd == "amend":
 			self.cmd_point(commit, **{'-f': True})
 		finally:
 		    if subcmd == "amend":
 			if stash:
-			    rc = os.system("git stash apply %s" % stash[0])
+			    rc = run_interactive(['git', 'stash', 'apply', stash[0]])
 			    if rc:
 				self.cmd_point(start[0], **{'-f': True})
-				os.system("git stash apply %s" % stash[0])
+				run_interactive(['git', 'stash', 'apply', stash[0]])
 				raise YapError("Failed to apply stash")
 			stash = None
 
@@ -980,15 +1579,16 @@ To skip the problematic patch, run \"yap history skip\"."""
 		stat = os.stat(tmpfile)
 		size = stat[6]
 		if size > 0:
-		    run_safely("git update-index --refresh")
-		    rc = os.system("git am -3 --resolvemsg=\'%s\' %s" % (resolvemsg, tmpfile))
+		    if self._refresh_index():
+			raise YapError("Failed to refresh the index")
+		    rc = run_interactive(['git', 'am', '-3', resolvemsg, tmpfile])
 		    if (rc):
 			raise YapError("Failed to apply changes")
             finally:
 		os.unlink(tmpfile)
         finally:
 	    if stash:
-		run_command("git stash apply %s" % stash[0])
+		run_command(['git', 'stash', 'apply', stash[0]])
         self.cmd_status()
 
     @short_help("show the changes introduced by a given commit")
@@ -1002,12 +1602,11 @@ the commit's author, log message, and a diff of the changes are shown.
         self._check_git()
         commit = self._resolve_rev(commit)
 
+	cmd = ['git', 'show']
 	if stdout_is_tty():
-	    color = "--color"
-	else:
-	    color = ""
+	    cmd.append('--color')
 
-        os.system("git show %s '%s'" % (color, commit))
+        run_interactive(cmd + [commit])
 
     @short_help("apply the changes in a given commit to the current branch")
     @long_help("""
@@ -1024,9 +1623,9 @@ branch.
         self._check_git()
         commit = self._resolve_rev(commit)
         if '-r' in flags:
-            os.system("git revert '%s'" % commit)
+            run_interactive(['git', 'revert', commit])
         else:
-            os.system("git cherry-pick '%s'" % commit)
+            run_interactive(['git', 'cherry-pick', commit])
 
     @short_help("list, add, or delete configured remote repositories")
     @long_help("""
@@ -1046,24 +1645,26 @@ a previously added repository.
         if '-d' in flags:
             if flags['-d'] not in [ x[0] for x in self._list_remotes() ]:
                 raise YapError("No such repository: %s" % flags['-d'])
-            os.system("git config --unset remote.%s.url" % flags['-d'])
-            os.system("git config --unset remote.%s.fetch" % flags['-d'])
-            for b in get_output("git for-each-ref --format='%%(refname)' 'refs/remotes/%s'" % flags['-d']):
-		hash = get_output("git rev-parse %s" % b)
-		assert hash
-		run_safely("git update-ref -d %s %s" % (b, hash[0]))
+            self._unset_config("remote.%s.url" % flags['-d'])
+            self._unset_config("remote.%s.fetch" % flags['-d'])
+            for b in get_output(['git', 'for-each-ref',
+                        '--format=%(objectname) %(refname)',
+                        'refs/remotes/%s' % flags['-d']]):
+		hash, b = b.split(' ', 1)
+		run_safely(['git', 'update-ref', '-d', b, hash])
 
         if name:
             if name in [ x[0] for x in self._list_remotes() ]:
                 raise YapError("Repository '%s' already exists" % name)
-            os.system("git config remote.%s.url %s" % (name, url))
-            os.system("git config remote.%s.fetch +refs/heads/*:refs/remotes/%s/*" % (name, name))
+            self._set_config("remote.%s.url" % name, url)
+            self._set_config("remote.%s.fetch" % name, "+refs/heads/*:refs/remotes/%s/*" % name)
 
         for remote, url in self._list_remotes():
             print "%s" % remote
             print "    URL:      %s" % url
             first = True
-            for b in get_output("git for-each-ref --format='%%(refname)' 'refs/remotes/%s'" % remote):
+            for b in get_output(['git', 'for-each-ref', '--format=%(refname)',
+                                    'refs/remotes/%s' % remote]):
                 b = b.replace('refs/remotes/', '')
                 if first:
                     branches = "Branches: "
@@ -1099,24 +1700,24 @@ To delete a branch on the remote repository, use the -d flag.
 	if repo and repo not in [ x[0] for x in self._list_remotes() ]:
 	    raise YapError("No such repository: %s" % repo)
 
-        current = get_output("git symbolic-ref HEAD")
+        current = self._get_head()
         if not current:
             raise YapError("Not on a branch!")
 
         self._check_rebasing()
 
-	current = current[0].replace('refs/heads/', '')
-	remote = get_output("git config branch.%s.remote" % current)
+	current = current.replace('refs/heads/', '')
+	remote = self._get_config("branch.%s.remote" % current)
         if repo is None and remote:
-            repo = remote[0]
+            repo = remote
 
         if repo is None:
             raise YapError("No tracking branch configured; specify destination repository")
 
-	if rhs is None and remote and remote[0] == repo:
-	    merge = get_output("git config branch.%s.merge" % current)
+	if rhs is None and remote and remote == repo:
+	    merge = self._get_config("branch.%s.merge" % current)
 	    if merge:
-		rhs = merge[0]
+		rhs = merge
 	
         if rhs is None:
             rhs = "refs/heads/%s" % current
@@ -1124,29 +1725,28 @@ To delete a branch on the remote repository, use the -d flag.
         self.cmd_fetch(repo)
 
 	if '-c' not in flags and '-d' not in flags:
-	    if run_command("git rev-parse --verify refs/remotes/%s/%s"
-		    % (repo, rhs.replace('refs/heads/', ''))):
+	    if self._objects().info("refs/remotes/%s/%s"
+		    % (repo, rhs.replace('refs/heads/', ''))) is None:
 		raise YapError("No matching branch on that repo.  Use -c to create a new branch there.")
             if '-f' not in flags:
-                hash = get_output("git rev-parse refs/remotes/%s/%s" % (repo, rhs.replace('refs/heads/', '')))
-                base = get_output("git merge-base HEAD %s" % hash[0])
-                assert base
-                if base[0] != hash[0]:
+                hash = self._objects().info("refs/remotes/%s/%s" % (repo, rhs.replace('refs/heads/', '')))
+                head = self._objects().info("HEAD")
+                if not self._ancestry().is_ancestor(hash[0], head[0]):
                     raise YapError("Branch not up-to-date with remote.  Update or use -f")
 
-                head = get_output("git rev-parse HEAD")
-                if base[0] == head[0]:
+                if hash[0] == head[0]:
                     raise YapError("All commits already in remote branch; nothing to do!")
 
 	self._confirm_push(current, rhs, repo)
+        push = ['git', 'push']
         if '-f' in flags:
-            flags['-f'] = '-f'
+            push.append('-f')
 	
 	if '-d' in flags:
 	    lhs = ""
 	else:
 	    lhs = "refs/heads/%s" % current
-	rc = os.system("git push %s %s %s:%s" % (flags.get('-f', ''), repo, lhs, rhs))
+	rc = run_interactive(push + [repo, "%s:%s" % (lhs, rhs)])
 	if rc:
 	    raise YapError("Push failed.")
 
@@ -1161,22 +1761,23 @@ argument.
     def cmd_fetch(self, repo=None):
         "<repo>"
         self._check_git()
-        current = get_output("git symbolic-ref HEAD")
+        current = self._get_head()
         if not current:
             raise YapError("Not on a branch!")
 
 	if repo and repo not in [ x[0] for x in self._list_remotes() ]:
 	    raise YapError("No such repository: %s" % repo)
         if repo is None:
-            current = current[0].replace('refs/heads/', '')
-            remote = get_output("git config branch.%s.remote" % current)
+            current = current.replace('refs/heads/', '')
+            remote = self._get_config("branch.%s.remote" % current)
             if remote:
-                repo = remote[0]
+                repo = remote
         if repo is None:
             raise YapError("No tracking branch configured; specify a repository")
-	rc = os.system("git fetch %s" % repo)
+	rc = run_interactive(['git', 'fetch', repo])
 	if rc:
 	    raise YapError("Fetch failed")
+	self._update_commit_graph()
 
     @short_help("update the current branch relative to its tracking branch")
     @long_help("""
@@ -1189,51 +1790,63 @@ the "skip" subcommand can be used to discard the conflicting changes.
 """)
     def cmd_update(self, subcmd=None):
         "[continue | skip]"
+        import tempfile
         self._check_git()
         if subcmd and subcmd not in ["continue", "skip"]:
             raise TypeError
 
-        resolvemsg = """
+        resolvemsg = """--resolvemsg=
 When you have resolved the conflicts run \"yap update continue\".
 To skip the problematic patch, run \"yap update skip\"."""
 
         if subcmd == "continue":
-            os.system("git am -3 -r --resolvemsg='%s'" % resolvemsg)
+            if run_interactive(['git', 'am', '-3', '-r', resolvemsg]) == 0:
+                self._update_commit_graph()
             return
         if subcmd == "skip":
-            os.system("git reset --hard")
-            os.system("git am -3 --skip --resolvemsg='%s'" % resolvemsg)
+            run_interactive(['git', 'reset', '--hard'])
+            if run_interactive(['git', 'am', '-3', '--skip', resolvemsg]) == 0:
+                self._update_commit_graph()
             return
 
         self._check_rebasing()
         if self._get_unstaged_files() or self._get_staged_files():
             raise YapError("You have uncommitted changes.  Commit them first")
 
-        current = get_output("git symbolic-ref HEAD")
+        current = self._get_head()
         if not current:
             raise YapError("Not on a branch!")
 
-	current = current[0].replace('refs/heads/', '')
+	current = current.replace('refs/heads/', '')
         remote, merge = self._get_tracking(current)
         merge = merge.replace('refs/heads/', '')
 
         print "Fetching %s and updating to %s/%s" % (remote, remote, merge)
 
         self.cmd_fetch(remote)
-        base = get_output("git merge-base HEAD refs/remotes/%s/%s" % (remote, merge))
+        base = self._ancestry().merge_base(self._resolve_rev('HEAD'),
+                self._resolve_rev('refs/remotes/%s/%s' % (remote, merge)))
+        if base is None:
+            raise YapError("%s/%s shares no history with HEAD"
+                    % (remote, merge))
 
         try:
             fd, tmpfile = tempfile.mkstemp("yap")
-            os.close(fd)
-            os.system("git format-patch -k --stdout '%s' > %s" % (base[0], tmpfile))
+            patch = os.fdopen(fd, 'w')
+            try:
+                run_command(['git', 'format-patch', '-k', '--stdout', base],
+                        stdout=patch)
+            finally:
+                patch.close()
             self.cmd_point("refs/remotes/%s/%s" % (remote, merge), **{'-f': True})
 
             stat = os.stat(tmpfile)
             size = stat[6]
             if size > 0:
-                rc = os.system("git am -3 --resolvemsg=\'%s\' %s" % (resolvemsg, tmpfile))
+                rc = run_interactive(['git', 'am', '-3', resolvemsg, tmpfile])
                 if (rc):
                     raise YapError("Failed to apply changes")
+                self._update_commit_graph()
         finally:
             os.unlink(tmpfile)
 
@@ -1249,10 +1862,10 @@ where to push local changes and from where to get updates to the branch.
         "[<repo> <branch>]"
         self._check_git()
 
-        current = get_output("git symbolic-ref HEAD")
+        current = self._get_head()
         if not current:
             raise YapError("Not on a branch!")
-	current = current[0].replace('refs/heads/', '')
+	current = current.replace('refs/heads/', '')
 
         if repo is None and branch is None:
             repo, merge = self._get_tracking(current)
@@ -1266,11 +1879,11 @@ where to push local changes and from where to get updates to the branch.
         if repo not in [ x[0] for x in self._list_remotes() ]:
             raise YapError("No such repository: %s" % repo)
 
-        if run_command("git rev-parse --verify refs/remotes/%s/%s" % (repo, branch)):
+        if self._objects().info("refs/remotes/%s/%s" % (repo, branch)) is None:
             raise YapError("No such branch '%s' on repository '%s'" % (branch, repo))
 
-        os.system("git config branch.%s.remote '%s'" % (current, repo))
-        os.system("git config branch.%s.merge 'refs/heads/%s'" % (current, branch))
+        self._set_config("branch.%s.remote" % current, repo)
+        self._set_config("branch.%s.merge" % current, "refs/heads/%s" % branch)
         print "Branch '%s' now tracking refs/remotes/%s/%s" % (current, repo, branch)
 
     @short_help("mark files with conflicts as resolved")
@@ -1286,30 +1899,30 @@ commits cannot be made.
         if not files:
             raise TypeError
         
-        for f in files:
-            self._stage_one(f, True)
+        self._stage_files(self._expand_directories(files, tracked=True), True)
         self.cmd_status()
 
     @short_help("merge a branch into the current branch")
     def cmd_merge(self, branch):
 	"<branch>"
+	import pickle
         self._check_git()
 
 	branch_name = branch
         branch = self._resolve_rev(branch)
-	base = get_output("git merge-base HEAD %s" % branch)
-	if not base:
+	base = self._ancestry().merge_base(self._resolve_rev('HEAD'), branch)
+	if base is None:
 	    raise YapError("Branch '%s' is not a fork of the current branch"
 		    % branch)
 
-	readtree = ("git read-tree --aggressive -u -m %s HEAD %s"
-		% (base[0], branch))
+	readtree = ['git', 'read-tree', '--aggressive', '-u', '-m',
+		base, 'HEAD', branch]
 	if run_command(readtree):
-	    run_command("git update-index --refresh")
-	    if os.system(readtree):
+	    self._refresh_index()
+	    if run_interactive(readtree):
 		raise YapError("Failed to merge")
 
-	repo = get_output('git rev-parse --git-dir')[0]
+	repo = self._get_git_dir()
         dir = os.path.join(repo, 'yap')
         try:
             os.mkdir(dir)
@@ -1320,13 +1933,13 @@ commits cannot be made.
 	print >>msg, "Merge branch '%s'" % branch_name
 	msg.close()
 
-	head = get_output("git rev-parse --verify HEAD")
+	head = self._objects().info("HEAD")
 	assert head
 	heads = [head[0], branch]
 	head_file = os.path.join(dir, 'merge')
 	pickle.dump(heads, file(head_file, 'w'))
 
-	self._merge_index(branch, base[0])
+	self._merge_index(branch, base)
 	if self._get_unmerged_files():
 	    self.cmd_status()
 	    raise YapError("Fix conflicts then commit")
@@ -1334,33 +1947,39 @@ commits cannot be made.
 	self._do_commit()
 
     def _merge_index(self, branch, base):
+	import tempfile
+	merged = []
 	for f in self._get_unmerged_files():
+	    data = self._objects().contents("%s:%s" % (base, f))
+	    assert data is not None
 	    fd, bfile = tempfile.mkstemp("yap")
-	    os.close(fd)
-	    rc = os.system("git show %s:%s > %s" % (base, f, bfile))
-	    assert rc == 0
+	    fd = os.fdopen(fd, 'w')
+	    fd.write(data)
+	    fd.close()
 
+	    data = self._objects().contents("%s:%s" % (branch, f))
+	    assert data is not None
 	    fd, ofile = tempfile.mkstemp("yap")
-	    os.close(fd)
-	    rc = os.system("git show %s:%s > %s" % (branch, f, ofile))
-	    assert rc == 0
+	    fd = os.fdopen(fd, 'w')
+	    fd.write(data)
+	    fd.close()
 
-	    command = "git merge-file -L %(file)s -L %(file)s.base -L %(file)s.%(branch)s %(file)s %(base)s %(other)s " % dict(file=f, branch=branch, base=bfile, other=ofile)
-	    rc = os.system(command)
+	    command = ['git', 'merge-file', '-L', f, '-L', f + '.base',
+		    '-L', '%s.%s' % (f, branch), f, bfile, ofile]
+	    rc = run_interactive(command)
 	    os.unlink(ofile)
 	    os.unlink(bfile)
 
 	    assert rc >= 0
 	    if rc == 0:
-		self._stage_one(f, True)
+		merged.append(f)
+	self._stage_files(merged, True)
 
     def cmd_help(self, cmd=None):
         if cmd is not None:
 	    oldcmd = cmd
             cmd = "cmd_" + cmd.replace('-', '_')
-            try:
-                attr = self.__getattribute__(cmd)
-            except AttributeError:
+            if cmd not in self._command_table():
                 raise YapError("No such command: %s" % cmd)
 
             help = self._get_attr(cmd, "long_help")
@@ -1378,14 +1997,9 @@ commits cannot be made.
         print >> sys.stderr, "Yet Another (Git) Porcelein"
         print >> sys.stderr
 
-        for name in dir(self):
-            if not name.startswith('cmd_'):
-                continue
-            attr = self.__getattribute__(name)
-            if not callable(attr):
-                continue
-
-            short_msg = self._get_attr(name, "short_help")
+        table = self._command_table()
+        for name in sorted(table):
+            short_msg = table[name].get("short_help")
             if short_msg is None:
 		continue
 
@@ -1400,23 +2014,38 @@ commits cannot be made.
     def cmd_plugins(self):
 	""
 	print >> sys.stderr, "Loaded plugins:"
-	plugins = load_plugins()
-	for name, cls in plugins.items():
-	    print "\t%-16s: %s" % (name, cls.__doc__)
+	plugins = [ (p['name'], p) for p in plugin_manifest().values() ]
+	plugins.sort()
+	for name, p in plugins:
+	    print "\t%-16s: %s" % (p['name'], p['doc'])
 	if not plugins:
 	    print "\t%-16s" % "None"
 
     def cmd_usage(self):
         print >> sys.stderr, "usage: %s <command>" % os.path.basename(sys.argv[0])
-        print >> sys.stderr, "  valid commands: help init clone add rm stage unstage status revert commit uncommit log show diff branch switch point cherry-pick repo track push fetch update history resolved version"
+        print >> sys.stderr, "  valid commands: help init clone add rm stage unstage status revert commit uncommit log show diff branch switch point cherry-pick repo track push fetch update history resolved version profile daemon sparse"
 
-def load_plugins():
+def _plugin_dir():
     plugindir = os.path.join("~", ".yap", "plugins")
     plugindir = os.path.expanduser(plugindir)
-    plugindir = os.path.join(plugindir, "*.py")
+    if plugindir not in sys.path:
+	sys.path.insert(0, plugindir)
+    return plugindir
+
+def _plugin_files():
+    plugindir = _plugin_dir()
+    try:
+	names = os.listdir(plugindir)
+    except OSError:
+	return []
+    names.sort()
+    return [ os.path.join(plugindir, x) for x in names
+		if x.endswith('.py') and not x.startswith('.') ]
 
+def load_plugins():
+    "Import every plugin and return the YapCore subclasses they define"
     plugins = dict()
-    for p in glob.glob(os.path.expanduser(plugindir)):
+    for p in _plugin_files():
 	plugin = os.path.basename(p).replace('.py', '')
 	m = __import__(plugin)
 	for k in dir(m):
@@ -1430,21 +2059,146 @@ def load_plugins():
 	    plugins[k] = cls
     return plugins
 
-def yap_metaclass(name, bases, dct):
-    plugindir = os.path.join("~", ".yap", "plugins")
-    plugindir = os.path.expanduser(plugindir)
-    sys.path.insert(0, plugindir)
-
-    plugins = set(load_plugins().values())
-    p2 = plugins.copy()
-    for cls in plugins:
-	p2 -= set(cls.__bases__)
-    plugins = p2
-    bases = list(plugins) + list(bases)
-    return type(name, tuple(bases), dct)
+def _code_names(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+	if hasattr(c, 'co_names'):
+	    names |= _code_names(c)
+    return names
+
+def _attr_names(attr):
+    "Return the names a method refers to, which may be other methods"
+    if isinstance(attr, (staticmethod, classmethod)):
+	attr = attr.__func__
+    code = getattr(attr, 'func_code', None)
+    if code is None:
+	return []
+    return sorted(_code_names(code))
+
+def _plugin_key(cls):
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+def _scan_plugins():
+    manifest = dict()
+    for cls in load_plugins().values():
+	attrs = dict()
+	for k, v in cls.__dict__.items():
+	    if k in ('__module__', '__doc__', '__dict__', '__weakref__'):
+		continue
+	    attrs[k] = _attr_names(v)
+	bases = [ _plugin_key(b) for b in cls.__bases__
+		    if issubclass(b, YapCore) and b is not YapCore ]
+	manifest[_plugin_key(cls)] = dict(module=cls.__module__,
+		name=cls.__name__, doc=cls.__doc__, bases=bases, attrs=attrs)
+    return manifest
+
+_manifest_magic = "yap plugin manifest 2\n"
+_manifest = None
+def plugin_manifest():
+    """Describe every plugin class: its module, name, docstring, plugin base
+    classes, and the attributes it defines with the names each one uses.
+    The description is cached in ~/.yap and rebuilt, by importing every
+    plugin, only when a plugin file is added, removed or modified."""
+    import marshal
+    global _manifest
+    if _manifest is not None:
+	return _manifest
+
+    files = []
+    for p in _plugin_files():
+	try:
+	    st = os.stat(p)
+	except OSError:
+	    continue
+	files.append((os.path.basename(p), st.st_mtime, st.st_size))
+
+    # marshal rather than pickle: it is built in, so loading is cheap
+    cache = os.path.join(os.path.dirname(_plugin_dir()), "plugin-manifest")
+    try:
+	fd = file(cache, 'rb')
+	# Never hand marshal anything but what we wrote
+	if fd.readline() == _manifest_magic:
+	    key, manifest = marshal.load(fd)
+	    if key == files:
+		_manifest = manifest
+		return manifest
+    except Exception:
+	pass
+
+    manifest = _scan_plugins()
+    tmp = "%s.%d" % (cache, os.getpid())
+    try:
+	fd = file(tmp, 'wb')
+	fd.write(_manifest_magic)
+	marshal.dump((files, manifest), fd)
+	fd.close()
+	os.rename(tmp, cache)
+    except (IOError, OSError):
+	try:
+	    os.unlink(tmp)
+	except OSError:
+	    pass
+    _manifest = manifest
+    return manifest
+
+# Methods that use these may run any method, named at run time
+_dynamic_names = set(['__getattribute__', 'getattr', 'dir', '__mro__'])
+
+def plugins_for(names):
+    """Return the manifest keys of the plugins that must be loaded before
+    running the named methods: those overriding any method the named ones
+    can reach, and any plugin built on top of one of those."""
+    manifest = plugin_manifest()
+    reached = set()
+    todo = list(names)
+    while todo:
+	name = todo.pop()
+	if name in reached:
+	    continue
+	reached.add(name)
+	if name in YapCore.__dict__:
+	    todo += _attr_names(YapCore.__dict__[name])
+	for p in manifest.values():
+	    todo += p['attrs'].get(name, [])
+
+    if reached & _dynamic_names:
+	return set(manifest)
+
+    needed = set()
+    for k, p in manifest.items():
+	if reached.intersection(p['attrs']):
+	    needed.add(k)
+    while True:
+	more = set()
+	for k, p in manifest.items():
+	    if k not in needed and needed.intersection(p['bases']):
+		more.add(k)
+	if not more:
+	    break
+	needed |= more
+    return needed
 
 class Yap(YapCore):
-    __metaclass__ = yap_metaclass
+
+    def _load_plugins(self, names):
+	"Mix in the plugins that override anything the named methods use"
+	manifest = plugin_manifest()
+	loaded = set([ _plugin_key(c) for c in self.__class__.__mro__ ])
+	plugins = []
+	for k in sorted(plugins_for(names) - loaded):
+	    p = manifest[k]
+	    m = __import__(p['module'])
+	    plugins.append(getattr(m, p['name']))
+	if not plugins:
+	    return
+
+	leaves = set(plugins)
+	for cls in plugins:
+	    leaves -= set(cls.__bases__)
+	leaves = [ c for c in plugins if c in leaves ]
+	self.__class__ = type(self.__class__.__name__,
+		tuple(leaves) + (self.__class__,), {})
+	self.__init__()
 
     def main(self, args):
         if len(args) < 1:
@@ -1454,27 +2208,17 @@ class Yap(YapCore):
         command = args[0]
         args = args[1:]
 
-	if run_command("git --version"):
-	    print >>sys.stderr, "Failed to run git; is it installed?"
-	    sys.exit(1)
-
         debug = os.getenv('YAP_DEBUG')
 
         try:
             command = command.replace('-', '_')
+	    self._load_plugins(["cmd_"+command])
 	    meth = self.__getattribute__("cmd_"+command)
-	    doc = self._get_attr("cmd_"+command, "__doc__")
+	    entry = self._command_table()["cmd_"+command]
+	    doc = entry.get("__doc__")
 
             try:
-		options = ""
-		for c in self.__class__.__bases__:
-		    try:
-			t = c.__dict__["cmd_"+command]
-		    except KeyError:
-			continue
-		    if "options" in t.__dict__:
-			options += t.options
-
+		options = entry['options']
 		if options:
 		    try:
 			flags, args = getopt.getopt(args, options)
@@ -1498,6 +2242,12 @@ class Yap(YapCore):
                     raise
                 print >> sys.stderr, e
                 sys.exit(1)
+            except OSError, e:
+                # Only look for git once something has failed to run
+                if e.errno != errno.ENOENT or find_program("git"):
+                    raise
+                print >> sys.stderr, "Failed to run git; is it installed?"
+                sys.exit(1)
         except AttributeError:
             if debug:
                 raise